@@ -44,7 +44,7 @@ setup(
     packages=["tabfix"],
     include_package_data=True,
     zip_safe=False,
-    extras_require={},
+    extras_require={"numpy": ["numpy"]},
     test_suite="tests.test_all",
     entry_points={
         "console_scripts": ["tabfix = tabfix.main:run"],
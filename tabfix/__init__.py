@@ -1,2 +1,13 @@
 # make version accessible as 'tabfix.__version__'
 from tabfix._version import __version__
+
+import sys
+
+if sys.version_info >= (3, 7):
+    # make the asyncio API accessible as 'tabfix.fix_paths' and 'tabfix.iter_fix'
+    # (imported on first access, so the command line tool does not load it)
+    def __getattr__(name):
+        if name in ("fix_paths", "iter_fix"):
+            from tabfix import aio
+            return getattr(aio, name)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
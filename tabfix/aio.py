@@ -0,0 +1,166 @@
+# (c) 2010, 2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+asyncio API (Python 3.7+).
+
+Fix files without blocking the event loop:
+
+    data = await tabfix.fix_paths(["src"], opts)
+
+    async for result in tabfix.iter_fix(["src"], opts):
+        print(result.path, result.modified)
+
+Folders are walked in a worker thread (using the same rules as the command
+line), files are processed in a bounded thread pool and results are yielded
+as they complete. No new files are started while the caller does not consume
+results (backpressure). Closing the generator stops the walk and discards
+files that were not started yet.
+
+Options that need a global commit stage (--output-dir, --zip-backup,
+--journal, --durability batch) are not supported. Without `opts`, nothing is
+printed (verbose=0).
+"""
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from tabfix import cmd_walker
+from tabfix.main import Opts, fix_tabs
+
+
+# Walker statistics that are not reported by the per-file results
+WALK_COUNTERS = ("dirs_processed", "dirs_ignored", "dirs_deduplicated",
+                 "files_ignored", "files_deduplicated", "files_relinked", "links_skipped")
+
+FixResult = namedtuple("FixResult", ("path", "modified", "data", "error"))
+FixResult.__doc__ = """Result of processing one file.
+
+`data` contains the statistics of this file. `error` is the exception raised
+while processing the file (only if opts.ignore_errors is set).
+"""
+
+# Marks the end of the file queue
+_END = object()
+
+
+def _check_options(opts):
+    if opts.output_path or opts.zip_backup or opts.journal_path:
+        raise ValueError("--output-dir, --zip-backup, and --journal are not "
+                         "supported by the asyncio API")
+    if opts.durability == "batch":
+        raise ValueError("--durability batch is not supported by the asyncio API")
+    return
+
+
+def _walk(paths, opts, data, queue, loop, stop_event, list_func):
+    """Put all files that the walker would process into the queue (in a thread)."""
+    files = cmd_walker.iter_files(paths, opts, data, list_func)
+    try:
+        for fspec in files:
+            if stop_event.is_set():
+                break
+            # Blocks while the queue is full (backpressure)
+            asyncio.run_coroutine_threadsafe(queue.put(fspec), loop).result()
+    finally:
+        files.close()
+        if not stop_event.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(_END), loop).result()
+    return
+
+
+def _fix_file(fspec, opts, func):
+    """Process a single file with its own statistics (in a worker thread)."""
+    data = cmd_walker._init_data({})
+    error = None
+    try:
+        cmd_walker._process_file(fspec, opts, func, data)
+    except Exception as e:
+        if not opts.ignore_errors:
+            raise
+        error = e
+    # Drop walker state that is meaningless for a single file
+    for key in ("elapsed", "elapsed_string", "visited_files", "pending_commits",
+                "journal_done", "journal_pending"):
+        data.pop(key, None)
+    return FixResult(fspec, data["files_modified"] > 0, data, error)
+
+
+async def iter_fix(paths, opts=None, func=fix_tabs, max_workers=4, max_pending=None,
+                   list_func=None, walk_data=None):
+    """Yield a FixResult for every processed file, in the order of completion.
+
+    At most `max_workers` files are processed concurrently and at most
+    `max_pending` discovered files are queued (default: 2 * max_workers).
+    Pass a dict as `walk_data` to receive the walker statistics.
+    Call `aclose()` when stopping early, so the walker is stopped and files
+    that are being processed are complete when it returns.
+    """
+    if opts is None:
+        opts = Opts()
+        opts.verbose = 0
+    _check_options(opts)
+    loop = asyncio.get_running_loop()
+    files = asyncio.Queue(maxsize=max_pending or 2 * max_workers)
+    stop_event = threading.Event()
+    walk_data = {} if walk_data is None else walk_data
+    # One additional thread for the walker
+    executor = ThreadPoolExecutor(max_workers + 1)
+    walker = loop.run_in_executor(executor, _walk, paths, opts, walk_data, files,
+                                  loop, stop_event, list_func)
+    pending = set()
+    get_task = None
+    walking = True
+    try:
+        while walking or pending:
+            if walking and get_task is None and len(pending) < max_workers:
+                get_task = asyncio.ensure_future(files.get())
+            waitables = set(pending)
+            if get_task is not None:
+                waitables.add(get_task)
+            done, _ = await asyncio.wait(waitables, return_when=asyncio.FIRST_COMPLETED)
+
+            if get_task in done:
+                fspec = get_task.result()
+                get_task = None
+                if fspec is _END:
+                    walking = False
+                    await walker  # Raise errors of the walker
+                else:
+                    pending.add(loop.run_in_executor(executor, _fix_file, fspec, opts, func))
+            for future in done & pending:
+                pending.remove(future)
+                yield future.result()
+        # Update the other names of hardlinked files (see iter_files())
+        await loop.run_in_executor(executor, cmd_walker.relink_hardlinks, opts, walk_data)
+    finally:
+        # Stop the walker (it may wait for free space in the queue)
+        stop_event.set()
+        if get_task is not None:
+            get_task.cancel()
+        while not walker.done():
+            while not files.empty():
+                files.get_nowait()
+            await asyncio.wait([walker], timeout=0.05)
+        # Files that are being processed can't be interrupted: let them
+        # complete their replacement (or remove their temp files)
+        await asyncio.gather(*pending, return_exceptions=True)
+        executor.shutdown(wait=False)
+
+
+async def fix_paths(paths, opts=None, func=fix_tabs, max_workers=4, max_pending=None,
+                    list_func=None):
+    """Process all files and return the summed up statistics (like cmd_walker.process())."""
+    data = cmd_walker._init_data({})
+    walk_data = {}
+    start = cmd_walker._timer()
+    async for result in iter_fix(paths, opts, func, max_workers, max_pending,
+                                 list_func, walk_data):
+        for key, value in result.data.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                data[key] = data.get(key, 0) + value
+    for key in WALK_COUNTERS:
+        data[key] += walk_data.get(key, 0)
+    data["elapsed"] = cmd_walker._timer() - start
+    data["elapsed_string"] = "%.3f sec" % data["elapsed"]
+    return data
@@ -15,31 +15,72 @@ Verbose modes (default: 3)
 from __future__ import print_function
 from __future__ import absolute_import
 
+from collections import deque
 from datetime import datetime
+import errno
 from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 import os
 import shutil
+import sys
+import threading
 import time
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile
+
+from tabfix.file_types import classify_buffer, get_classifier
+from tabfix.ignore_rules import IgnoreRules
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
 
 
 TEMP_SUFFIX = ".$temp"
 BACKUP_SUFFIX = ".bak"
 
+# Available values for --durability
+DURABILITY_MODES = ("none", "file", "batch")
+
+# Journal lines starting with this prefix store the backup archive's path
+JOURNAL_ZIPFILE_PREFIX = "#zipfile "
+
+# The journal stores paths as bytes, so names that are not valid in the file
+# system encoding (surrogate-escaped) round-trip (Python 2: paths are bytes)
+_fsencode = getattr(os, "fsencode", lambda fspec: fspec)
+_fsdecode = getattr(os, "fsdecode", lambda fspec: fspec)
+
+# Kernel-side copy functions used by --output-dir (best first).
+# sendfile() only accepts a regular file as target on Linux (BSD, macOS: socket)
+_ZERO_COPY_FUNCS = [name for name in ("copy_file_range", "sendfile") if hasattr(os, name)
+                    and (name != "sendfile" or sys.platform.startswith("linux"))]
+
+# Maximum number of threads used by --read-ahead and --write-behind
+PIPELINE_THREADS = 4
+
+if hasattr(os, "posix_fadvise"):
+    def _fadvise_willneed(fd):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+else:  # Windows, Python 2
+    _fadvise_willneed = None
+
+# `time.clock()` was removed in Python 3.8
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.clock
+
 
 def is_text_file(filename, blocksize=512):
+    """Return True if the file looks like text (see file_types.classify_buffer())."""
     try:
         with open(filename, "rb") as f:
             s = f.read(blocksize)
     except IOError:
         return False
-
-    if b"\0" in s:
-        return False
-    if not s:  # Empty files are considered text
-        return True
-    return True
+    # Note: empty files are considered text
+    return classify_buffer(s)[0]
 
 
 def increment_data(data, key, inc=1):
@@ -51,6 +92,87 @@ def increment_data(data, key, inc=1):
     return
 
 
+def is_first_visit(fspec, data, key, st=None):
+    """Return False if the file system object was already registered in data[key].
+
+    Objects are identified by (st_dev, st_ino), so hardlinks and symlinks that
+    resolve to the same physical file or folder are only visited once.
+    Pass `st` if the result of os.stat(fspec) is already known.
+    """
+    if st is None:
+        try:
+            st = os.stat(fspec)
+        except OSError:
+            return True
+    if not st.st_ino:  # No inode numbers available (e.g. Python 2 on Windows)
+        return True
+    inode = (st.st_dev, st.st_ino)
+    visited = data.setdefault(key, set())
+    if inode in visited:
+        return False
+    visited.add(inode)
+    return True
+
+
+def _visit_file(fspec, data):
+    """Return False if <fspec> is another name of a file that was already visited.
+
+    Names of files with more than one hardlink are recorded in data["hardlinks"]
+    (symlinks are not), so relink_hardlinks() can update the other names.
+    """
+    try:
+        st = os.stat(fspec)
+    except OSError:
+        return True
+    first = is_first_visit(fspec, data, "visited_files", st)
+    if st.st_nlink > 1 and st.st_ino and not os.path.islink(fspec):
+        names = data.setdefault("hardlinks", {}).setdefault((st.st_dev, st.st_ino), [])
+        names.append(os.path.abspath(fspec))
+    return first
+
+
+def relink_hardlinks(opts, data):
+    """Link the other names of replaced hardlinked files to the new file.
+
+    Only the first name of a hardlinked file is processed; replacing it (by
+    renaming the temp file) breaks the link. The other names that were
+    visited by the walker are replaced by a hardlink to the new file (via a
+    temp name and a rename, so every name always has a complete content).
+    Names outside the walked tree keep the old file.
+    """
+    groups = data.pop("hardlinks", {})
+    if opts.dry_run:
+        return
+    folders = set()
+    for inode, names in groups.items():
+        first = names[0]
+        try:
+            st = os.stat(first)
+        except OSError:
+            continue
+        if len(names) < 2 or (st.st_dev, st.st_ino) == inode:
+            continue  # Not replaced
+        for fspec in names[1:]:
+            try:
+                st = os.lstat(fspec)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) != inode:
+                continue  # Replaced meanwhile
+            temp_fspec = fspec + TEMP_SUFFIX
+            if os.path.exists(temp_fspec):
+                os.remove(temp_fspec)
+            os.link(first, temp_fspec)
+            # (os.replace() is not available on Python 2)
+            getattr(os, "replace", os.rename)(temp_fspec, fspec)
+            data["files_relinked"] += 1
+            folders.add(os.path.dirname(fspec))
+    if opts.durability != "none":
+        for folder in sorted(folders):
+            _fsync_folder(folder, data)
+    return
+
+
 def is_matching(fspec, match_list):
     """Return True if the name part of fspec matches the pattern (using fnmatch)."""
     if match_list:
@@ -74,13 +196,31 @@ class WalkerOptions(object):
     """
     def __init__(self):
         self.backup = True
+        self.binary_extensions = None
         self.dry_run = False
+        self.durability = "none"
+        self.durability_batch = 500
+        self.follow_symlinks = True
         self.ignore_errors = False
         self.ignore_list = None
+        self.journal_batch = 100
+        self.journal_path = None
         self.match_list = None
+        self.output_link = False
+        self.output_path = None
+        self.progress = False
+        self.read_ahead = 0
+        self.read_ahead_bytes = 64 * 1024 * 1024
+        # The processor never writes (e.g. --scan): don't create or remove temp files
+        self.read_only = False
         self.recursive = False
         self.target_path = None
+        self.text_extensions = None
+        self.use_ignore_files = False
         self.verbose = 3
+        self.walk_ordered = True
+        self.walk_threads = 0
+        self.write_behind = 0
         self.zip_backup = False
 
 
@@ -88,89 +228,833 @@ class WalkerOptions(object):
 # Walker
 # ==============================================================================
 def _process_file(fspec, opts, func, data):
+    pipeline = data.get("pipeline")
+    try:
+        _process_file_stages(fspec, opts, func, data, pipeline)
+    finally:
+        if pipeline:
+            pipeline.collect(data)
+    return
+
+
+def _process_file_stages(fspec, opts, func, data, pipeline):
+    prefetched = None
+    if pipeline:
+        # Always take the buffer, so it is released even if the file is skipped
+        prefetched = pipeline.take(fspec, data)
+
     # handle --ignore
     if is_matching(fspec, opts.ignore_list):
         data["files_ignored"] += 1
         return False
 
+    # Files with a known binary extension are rejected before stat() or open()
+    # (and only copied to the --output-dir tree)
+    if get_classifier(opts).is_binary_name(fspec):
+        data["files_processed"] += 1
+        data["files_skipped"] += 1
+        increment_data(data, "classified_binary_extension")
+        if opts.output_path and not opts.dry_run:
+            try:
+                copy_file(fspec, _output_fspec(fspec, data), opts, data)
+            except Exception:
+                data["exceptions"] += 1
+                raise
+        return False
+
     fspec = os.path.abspath(fspec)
     if not os.path.isfile(fspec):
         ValueError("Invalid fspec: %s" % fspec)
 
+    # handle --journal: skip files that were finished by a previous run
+    if fspec in data["journal_done"]:
+        data["files_resumed"] += 1
+        return False
+
+    # Process every physical file only once (hardlinks, symlinks).
+    # (Not in --output-dir mode, where every path gets its own copy.)
+    if not opts.output_path and not _visit_file(fspec, data):
+        data["files_deduplicated"] += 1
+        return False
+
     try:
-        target_fspec = opts.target_path or fspec
-        target_fspec = os.path.abspath(target_fspec)
+        if opts.output_path:
+            target_fspec = _output_fspec(fspec, data)
+        else:
+            target_fspec = opts.target_path or fspec
+            target_fspec = os.path.abspath(target_fspec)
 
         assert not fspec.endswith(TEMP_SUFFIX)
         assert not target_fspec.endswith(TEMP_SUFFIX)
-        temp_fspec = fspec + TEMP_SUFFIX
-        if os.path.exists(temp_fspec):
+        if opts.read_only or (opts.output_path and opts.dry_run):
+            # Never touch the file system (--output-dir: the source tree may
+            # be read-only and the output tree is not created in dry-run mode)
+            temp_fspec = None
+        elif opts.output_path:
+            # Never write to the source tree
+            temp_fspec = target_fspec + TEMP_SUFFIX
+        else:
+            temp_fspec = fspec + TEMP_SUFFIX
+        if temp_fspec and os.path.exists(temp_fspec):
             os.remove(temp_fspec)
 
         try:
             data["files_processed"] += 1
+            if prefetched is not None:
+                data["prefetched"] = (fspec, prefetched)
             res = func(fspec, temp_fspec, opts, data)
             if res is not False:
                 data["files_modified"] += 1
-        except Exception:
-            raise
+        finally:
+            data.pop("prefetched", None)
         #
         if res is False or opts.dry_run:
             # If processor returns False (or we are in dry run mode), don't
             # change the file
-            if os.path.exists(temp_fspec):
+            if temp_fspec and os.path.exists(temp_fspec):
                 os.remove(temp_fspec)
-        elif opts.backup:
-            if opts.zip_backup:
-                if os.path.exists(target_fspec):
-                    if not data.get("zipfile"):
-                        data["zipfile"] = ZipFile(data["zipfile_fspec"], "w")
-                    relPath = os.path.relpath(target_fspec, data["zipfile_folder"])
-                    data["zipfile"].write(target_fspec, arcname=relPath)
-            else:
-                bakFilePath = "%s%s" % (target_fspec, BACKUP_SUFFIX)
-                if os.path.exists(bakFilePath):
-                    os.remove(bakFilePath)
-                if os.path.exists(target_fspec):
-                    shutil.move(target_fspec, bakFilePath)
-            shutil.move(temp_fspec, target_fspec)
+            if opts.output_path and not opts.dry_run:
+                copy_file(fspec, target_fspec, opts, data)
+            _journal_done(fspec, opts, data)
+        elif opts.durability == "batch":
+            if opts.output_path:
+                shutil.copymode(fspec, temp_fspec)
+            # Group commit: sync and rename many temp files at once
+            data["pending_commits"].append((fspec, temp_fspec, target_fspec))
+            if len(data["pending_commits"]) >= opts.durability_batch:
+                flush_commits(opts, data)
         else:
-            if os.path.exists(target_fspec):
-                os.remove(target_fspec)
-            shutil.move(temp_fspec, target_fspec)
+            if opts.output_path:
+                shutil.copymode(fspec, temp_fspec)
+            elif opts.backup and opts.zip_backup:
+                _zip_backup(target_fspec, data)
+            if opts.durability == "file" and data.get("zipfile"):
+                _fsync_zip(data)
+            if pipeline and pipeline.write_pool:
+                # --write-behind: the journal is updated when the commit is collected
+                pipeline.commit(fspec, temp_fspec, target_fspec)
+            else:
+                data["fsync_calls"] += _commit_file(temp_fspec, target_fspec, opts)
+                _journal_done(fspec, opts, data)
     except Exception:
         data["exceptions"] += 1
         raise
     return
 
 
-def _process_folder(path, opts, func, data):
-    """Process matching files inside <path> folder (potentially recursive)."""
+def _commit_file(temp_fspec, target_fspec, opts):
+    """Move a complete temp file to its target (making it durable if requested).
+
+    This may run in a worker thread (--write-behind), so it must not modify
+    `data` or other shared state.
+    Return the number of fsync calls.
+    """
+    stats = {"fsync_calls": 0}
+    if opts.durability == "file":
+        _fsync_file(temp_fspec, stats)
+    _replace_file(temp_fspec, target_fspec, opts)
+    if opts.durability == "file":
+        _fsync_folder(os.path.dirname(target_fspec), stats)
+    return stats["fsync_calls"]
+
+
+def _open_zip_part(data):
+    """Start a new part of the backup archive (one per journal checkpoint).
+
+    The first part is named `<base>.zip`, the following ones `<base>_partN.zip`.
+    With --journal the part is recorded before it holds any backup, so a
+    resumed run knows all parts of the archive.
+    """
+    parts = data["zipfile_parts"]
+    base = data["zipfile_base"]
+    i = len(parts) + 1
+    zip_fspec = base + ".zip" if i == 1 else "%s_part%d.zip" % (base, i)
+    # Never overwrite an existing archive
+    while os.path.exists(zip_fspec):
+        i += 1
+        zip_fspec = "%s_part%d.zip" % (base, i)
+    parts.append(zip_fspec)
+    data["zipfile"] = ZipFile(zip_fspec, "w")
+    journal = data.get("journal")
+    if journal:
+        journal.write(_fsencode(JOURNAL_ZIPFILE_PREFIX + zip_fspec) + b"\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    return
+
+
+def _zip_backup(target_fspec, data):
+    """Add the file that is about to be replaced to the backup archive."""
+    if os.path.exists(target_fspec):
+        if not data.get("zipfile"):
+            _open_zip_part(data)
+        relPath = os.path.relpath(target_fspec, data["zipfile_folder"])
+        data["zipfile"].write(target_fspec, arcname=relPath)
+    return
+
+
+def _replace_file(temp_fspec, target_fspec, opts):
+    """Move temp file to target (renaming an existing target to *.bak if requested)."""
+    if opts.backup and not opts.zip_backup and not opts.output_path:
+        bakFilePath = "%s%s" % (target_fspec, BACKUP_SUFFIX)
+        if os.path.exists(bakFilePath):
+            os.remove(bakFilePath)
+        if os.path.exists(target_fspec):
+            shutil.move(target_fspec, bakFilePath)
+    elif not opts.backup or opts.output_path:
+        if os.path.exists(target_fspec):
+            os.remove(target_fspec)
+    shutil.move(temp_fspec, target_fspec)
+    return
+
+
+def _output_fspec(fspec, data):
+    """Return the path of <fspec> in the --output-dir tree."""
+    source_root, output_root = data["output_root"]
+    rel_path = os.path.relpath(os.path.abspath(fspec), source_root)
+    return os.path.normpath(os.path.join(output_root, rel_path))
+
+
+def _zero_copy(fsrc, fdst, size):
+    """Copy file content inside the kernel; return False if not supported."""
+    in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+    for name in _ZERO_COPY_FUNCS:
+        offset = 0
+        try:
+            while offset < size:
+                if name == "copy_file_range":
+                    n = os.copy_file_range(in_fd, out_fd, size - offset, offset, offset)
+                else:
+                    n = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if not n:  # File was truncated meanwhile
+                    break
+                offset += n
+        except OSError as e:
+            # Not supported for this file system or kernel: try next method
+            if offset == 0 and e.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                           errno.ENOTSUP, errno.EOPNOTSUPP, errno.EBADF,
+                                           errno.ENOTSOCK):
+                continue
+            raise
+        return True
+    return False
+
+
+def copy_file(fspec, target_fspec, opts, data):
+    """Copy an unmodified file to the --output-dir tree.
+
+    The content is copied by the kernel (`copy_file_range()` or `sendfile()`)
+    if possible, or hardlinked if `opts.output_link` is set.
+    """
+    if os.path.exists(target_fspec):
+        os.remove(target_fspec)
+    if opts.output_link:
+        try:
+            os.link(fspec, target_fspec)
+            data["files_linked"] += 1
+            return
+        except (AttributeError, OSError):  # e.g. different devices: copy instead
+            pass
+    with open(fspec, "rb") as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        with open(target_fspec, "wb") as fdst:
+            if not _zero_copy(fsrc, fdst, size):
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(fspec, target_fspec)
+    data["files_copied"] += 1
+    data["bytes_copied"] += size
+    return
+
+
+def _fsync_file(fspec, data):
+    """Flush file content to disk."""
+    with open(fspec, "rb+") as f:
+        os.fsync(f.fileno())
+    data["fsync_calls"] += 1
+    return
+
+
+def _fsync_zip(data):
+    """Flush the backup archive (entries written so far) to disk."""
+    fp = data["zipfile"].fp
+    fp.flush()
+    os.fsync(fp.fileno())
+    data["fsync_calls"] += 1
+    return
+
+
+def _fsync_folder(path, data):
+    """Flush folder entries to disk, so renames become durable (POSIX only)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # Windows can't open folders
+        return
+    try:
+        os.fsync(fd)
+        data["fsync_calls"] += 1
+    except OSError:  # Not supported by this file system
+        pass
+    finally:
+        os.close(fd)
+    return
+
+
+def flush_commits(opts, data):
+    """Make pending temp files durable and move them to their targets.
+
+    Used by `--durability batch`:
+    1. Write zip backups of all targets
+    2. Flush all temp files (and the archive)
+    3. Rename all temp files to their targets
+    4. Flush every affected folder once
+    """
+    pending = data.get("pending_commits")
+    if not pending:
+        return
+    data["pending_commits"] = []
+
+    if opts.backup and opts.zip_backup:
+        for _fspec, _temp_fspec, target_fspec in pending:
+            _zip_backup(target_fspec, data)
+    for _fspec, temp_fspec, _target_fspec in pending:
+        _fsync_file(temp_fspec, data)
+    if data.get("zipfile"):
+        _fsync_zip(data)
+
+    folders = set()
+    for _fspec, temp_fspec, target_fspec in pending:
+        _replace_file(temp_fspec, target_fspec, opts)
+        folders.add(os.path.dirname(target_fspec))
+    for folder in sorted(folders):
+        _fsync_folder(folder, data)
+    for fspec, _temp_fspec, _target_fspec in pending:
+        _journal_done(fspec, opts, data)
+    return
+
+
+# ==============================================================================
+# Journal
+# ==============================================================================
+def _open_journal(opts, data):
+    """Load the list of finished files and open the journal for appending (--journal).
+
+    In dry-run mode the journal is only read (so the run shows what a resumed
+    run would do), because no file is finished.
+    Return the backup archive parts that were recorded by previous runs.
+    """
+    done = set()
+    zip_parts = []
+    if os.path.exists(opts.journal_path):
+        with open(opts.journal_path, "rb") as f:
+            for line in f:
+                # Note: an incomplete last line (killed while writing) never
+                # matches a path, so that file is simply processed again
+                line = _fsdecode(line.rstrip(b"\n"))
+                if line.startswith(JOURNAL_ZIPFILE_PREFIX):
+                    zip_parts.append(line[len(JOURNAL_ZIPFILE_PREFIX):])
+                elif line:
+                    done.add(line)
+        data["journal_resume"] = True
+    data["journal_done"] = done
+    if not opts.dry_run:
+        data["journal"] = open(opts.journal_path, "ab")
+    return zip_parts
+
+
+def _journal_done(fspec, opts, data):
+    """Mark a file as finished (written to the journal in batches)."""
+    if data.get("journal"):
+        data["journal_pending"].append(fspec)
+        if len(data["journal_pending"]) >= opts.journal_batch:
+            flush_journal(opts, data)
+    return
+
+
+def flush_journal(opts, data):
+    """Append pending finished files to the journal and make it durable.
+
+    The current part of the backup archive is closed (i.e. its central
+    directory is written) and flushed first, so the backups of all recorded
+    files are readable, even if the run is killed later. The next backup
+    starts a new part.
+    """
+    if not data.get("journal"):
+        return
+    if data.get("zipfile"):
+        data.pop("zipfile").close()
+        _fsync_file(data["zipfile_parts"][-1], data)
+    journal = data["journal"]
+    for fspec in data["journal_pending"]:
+        journal.write(_fsencode(fspec) + b"\n")
+    data["journal_pending"] = []
+    journal.flush()
+    os.fsync(journal.fileno())
+    return
+
+
+def _recover_folder(path, opts, data):
+    """Clean up file replacements that were interrupted by a previous run (--journal).
+
+    A temp file may be incomplete (the run was killed while the processor
+    wrote it), but the target is only renamed or removed after the temp file
+    is complete, so
+    - if the target still exists, the replacement never started: roll back
+      by discarding the temp file (the target will be processed again)
+    - if the target is missing, the run was killed between making the backup
+      and renaming: complete the replacement
+    In --output-dir mode <path> is the output folder and the sources are
+    untouched, so temp files are always discarded.
+    Return True if temp files were found.
+    """
+    changed = False
+    for name in os.listdir(path):
+        if not name.endswith(TEMP_SUFFIX):
+            continue
+        temp_fspec = os.path.join(path, name)
+        target_fspec = temp_fspec[:-len(TEMP_SUFFIX)]
+        if opts.output_path or os.path.exists(target_fspec):
+            os.remove(temp_fspec)
+            data["files_rolled_back"] += 1
+        else:
+            shutil.move(temp_fspec, target_fspec)
+            data["files_recovered"] += 1
+            data["journal_done"].add(os.path.abspath(target_fspec))
+            _journal_done(os.path.abspath(target_fspec), opts, data)
+        changed = True
+    return changed
+
+
+def list_folder(path):
+    """Return a list of (name, is_file, is_link) tuples for the entries of <path>.
+
+    `is_file` follows symbolic links. This is the default listing function of
+    process(). Replacements (e.g. to simulate latency in benchmarks) must
+    behave the same way.
+    """
+    if hasattr(os, "scandir"):
+        # Uses the file types returned by the OS, so most entries need no stat()
+        return [(entry.name, entry.is_file(), entry.is_symlink())
+                for entry in os.scandir(path)]
+    res = []
+    for name in os.listdir(path):
+        f = os.path.join(path, name)
+        res.append((name, os.path.isfile(f), os.path.islink(f)))
+    return res
+
+
+def _scan_folder(path, opts, rules, list_func):
+    """List <path> and classify its entries.
+
+    This may run in a worker thread (--walk-threads), so it must not modify
+    `data` or other shared state.
+    Return (stat, rules, entries), where `rules` is the IgnoreRules stack of
+    <path> (--use-ignore-files) and `entries` is a list of (kind, fspec) tuples
+    in listing order. `kind` is one of
+        'file':         matching file
+        'unmatched':    file that doesn't match --match
+        'ignored_file': file excluded by --exclude or ignore files
+        'ignored_dir':  folder excluded by --exclude or ignore files
+        'link':         symbolic link skipped by --skip-symlinks
+        'dir':          sub folder (only if --recursive)
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if opts.use_ignore_files:
+        rules = (rules or IgnoreRules()).enter(path)
+    entries = []
+    for name, is_file, is_link in list_func(path):
+        f = os.path.join(path, name)
+        # handle --ignore and ignore files (prune folders before listing them)
+        if (is_matching(name, opts.ignore_list)
+                or (rules and rules.is_ignored(f, not is_file))):
+            kind = "ignored_file" if is_file else "ignored_dir"
+        # handle --skip-symlinks
+        elif is_link and not opts.follow_symlinks:
+            kind = "link"
+        elif is_file:
+            # handle --match (only applied to files)
+            if opts.match_list and not is_matching(name, opts.match_list):
+                kind = "unmatched"
+            else:
+                kind = "file"
+        elif opts.recursive:
+            kind = "dir"
+        else:
+            continue
+        entries.append((kind, f))
+    return st, rules, entries
+
+
+# ==============================================================================
+# FolderScanner
+# ==============================================================================
+class FolderScanner(object):
+    """List folders for the walker, optionally ahead of time (--walk-threads).
+
+    Listing folders is I/O bound (and releases the GIL), so on network or FUSE
+    mounts a thread pool can list many folders while the main thread
+    processes files.
+    """
+    def __init__(self, opts, list_func=None):
+        self.opts = opts
+        self.list_func = list_func or list_folder
+        self.pool = None
+        self.pending = {}
+        if opts.walk_threads > 1:
+            self.pool = ThreadPool(opts.walk_threads)
+
+    def scan(self, path, rules):
+        """List <path> synchronously (see _scan_folder())."""
+        return _scan_folder(path, self.opts, rules, self.list_func)
+
+    def _scan_to_queue(self, path, rules, queue):
+        try:
+            queue.put((path, rules, self.scan(path, rules), None))
+        except Exception as e:
+            queue.put((path, rules, None, e))
+
+    def submit(self, path, rules, queue):
+        """List <path> in the pool and put a (path, rules, listing, error) tuple into queue."""
+        self.pool.apply_async(self._scan_to_queue, (path, rules, queue))
+
+    def prefetch(self, rules, entries):
+        """Start listing the sub folders of a folder that is about to be processed."""
+        if self.pool:
+            for kind, f in entries:
+                if kind == "dir" and f not in self.pending:
+                    self.pending[f] = self.pool.apply_async(self.scan, (f, rules))
+        return
+
+    def take(self, path, rules, rescan=False):
+        """Return the listing of <path> (wait for a prefetched result if any)."""
+        res = self.pending.pop(path, None)
+        if res is None or rescan:
+            return self.scan(path, rules)
+        return res.get()
+
+    def close(self):
+        if self.pool:
+            # Discard listings that were prefetched, but not needed
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending = {}
+        return
+
+
+# ==============================================================================
+# FilePipeline
+# ==============================================================================
+class FilePipeline(object):
+    """Overlap file I/O with the transformation in the main thread.
+
+    --read-ahead N: a thread pool reads up to N of the following files into
+        memory (at most `opts.read_ahead_bytes` in total). Files that don't fit
+        are announced to the OS instead (`posix_fadvise(WILLNEED)`), so the
+        kernel reads them in the background.
+        The processor finds the content in data["prefetched"] (see
+        get_prefetched()).
+    --write-behind N: a thread pool flushes (--durability file) and renames up
+        to N modified files, while the main thread continues with the next
+        files. Backup archives and the journal are only written by the main
+        thread, when a commit is collected.
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self.read_pool = None
+        self.write_pool = None
+        self.lock = threading.Lock()
+        # Files to read ahead (next first), and (fspec, AsyncResult) in flight
+        self.upcoming = deque()
+        self.skipped = set()
+        self.reads = {}
+        self.buffered_bytes = 0
+        self.commits = deque()
+        self.classifier = get_classifier(opts)
+        if opts.read_ahead > 0:
+            self.read_pool = ThreadPool(min(opts.read_ahead, PIPELINE_THREADS))
+        if opts.write_behind > 0:
+            self.write_pool = ThreadPool(min(opts.write_behind, PIPELINE_THREADS))
+
+    def schedule(self, fspecs):
+        """Announce files that will be processed next (in this order).
+
+        They are processed before all files that were announced earlier (the
+        walker recurses into sub folders before it continues with the files
+        of the parent folder).
+        """
+        if self.read_pool:
+            self.upcoming.extendleft(reversed(fspecs))
+            self._fill()
+        return
+
+    def _fill(self):
+        while self.upcoming and len(self.reads) < self.opts.read_ahead:
+            fspec = self.upcoming.popleft()
+            if fspec in self.skipped:
+                self.skipped.discard(fspec)
+            elif not self.classifier.is_binary_name(fspec):
+                self.reads[fspec] = self.read_pool.apply_async(self._read, (fspec,))
+        return
+
+    def _read(self, fspec):
+        """Return (content, size, advised); content is None if it would exceed the budget.
+
+        Runs in a worker thread.
+        """
+        try:
+            with open(fspec, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                with self.lock:
+                    fits = self.buffered_bytes + size <= self.opts.read_ahead_bytes
+                    if fits:
+                        self.buffered_bytes += size
+                if not fits:
+                    if _fadvise_willneed is None:
+                        return None, 0, False
+                    _fadvise_willneed(f.fileno())
+                    return None, 0, True
+                try:
+                    return f.read(), size, False
+                except Exception:
+                    with self.lock:
+                        self.buffered_bytes -= size
+                    raise
+        except (IOError, OSError):
+            # The processor will report the error when it opens the file
+            return None, 0, False
+
+    def take(self, fspec, data):
+        """Return the content of <fspec> if it was read ahead (or None)."""
+        if not self.read_pool or self.classifier.is_binary_name(fspec):
+            return None
+        res = self.reads.pop(fspec, None)
+        if res is None:
+            # Not started yet (e.g. the processing order differs from the
+            # announced order): don't read it later
+            self.skipped.add(fspec)
+            return None
+        buf, size, advised = res.get()
+        with self.lock:
+            self.buffered_bytes -= size
+        self._fill()
+        if buf is not None:
+            data["files_read_ahead"] += 1
+            data["bytes_read_ahead"] += size
+        elif advised:
+            data["files_advised"] += 1
+        return buf
+
+    def discard(self, fspecs):
+        """Release announced files that will not be processed (e.g. after an error)."""
+        if not self.read_pool:
+            return
+        for fspec in fspecs:
+            res = self.reads.pop(fspec, None)
+            if res is not None:
+                size = res.get()[1]
+                with self.lock:
+                    self.buffered_bytes -= size
+            elif not self.classifier.is_binary_name(fspec):
+                self.skipped.add(fspec)
+        self._fill()
+        return
+
+    def commit(self, fspec, temp_fspec, target_fspec):
+        """Start moving a complete temp file to its target (see _commit_file())."""
+        if len(self.commits) >= self.opts.write_behind:
+            # Backpressure: wait until the oldest commit is done
+            self.commits[0][1].wait()
+        res = self.write_pool.apply_async(_commit_file, (temp_fspec, target_fspec, self.opts))
+        self.commits.append((fspec, res))
+        return
+
+    def collect(self, data, wait=False):
+        """Update statistics and journal for finished commits (in order)."""
+        while self.commits and (wait or self.commits[0][1].ready()):
+            fspec, res = self.commits.popleft()
+            try:
+                data["fsync_calls"] += res.get()
+            except Exception:
+                data["exceptions"] += 1
+                raise
+            _journal_done(fspec, self.opts, data)
+        return
+
+    def close(self, data):
+        """Wait for all commits and stop the threads.
+
+        Return the first error of a commit (or None).
+        """
+        error = None
+        while self.commits:
+            try:
+                self.collect(data, wait=True)
+            except Exception as e:
+                error = error or e
+        for pool in (self.read_pool, self.write_pool):
+            if pool:
+                pool.terminate()
+                pool.join()
+        self.read_pool = self.write_pool = None
+        self.reads = {}
+        self.upcoming.clear()
+        return error
+
+
+def get_prefetched(fspec, data):
+    """Return the content of <fspec>, if it was read ahead (--read-ahead), or None."""
+    prefetched = data.get("prefetched")
+    if prefetched and prefetched[0] == os.path.abspath(fspec):
+        return prefetched[1]
+    return None
+
+
+def _enter_folder(path, opts, data):
+    """Prepare processing of a folder.
+
+    Return (output_folder, changed), where `changed` is True if the content of
+    <path> was modified by recovering interrupted replacements.
+    """
+    output_folder = None
+    if opts.output_path:
+        output_folder = _output_fspec(path, data)
+        if not opts.dry_run and not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+    changed = False
+    if data.get("journal_resume") and not opts.dry_run:
+        changed = _recover_folder(output_folder or path, opts, data)
+    return output_folder, changed
+
+
+def _count_skipped_entry(kind, data):
+    """Count a folder entry that is neither a matching file nor a sub folder."""
+    if kind == "link":
+        data["links_skipped"] += 1
+    elif kind == "ignored_dir":
+        data["dirs_ignored"] += 1
+    else:
+        data["files_ignored"] += 1
+    return
+
+
+def _process_entries(entries, output_folder, opts, func, data):
+    """Process the files of a folder listing in order.
+
+    Yield sub folders at their position, so the caller can recurse (or
+    schedule them) there.
+    """
+    pipeline = data.get("pipeline")
+    files = [f for kind, f in entries if kind == "file"]
+    if pipeline:
+        pipeline.schedule(files)
+    started = 0
+    try:
+        for kind, f in entries:
+            if kind == "file":
+                started += 1
+                _process_file(f, opts, func, data)
+            elif kind == "dir":
+                yield f
+            else:
+                _count_skipped_entry(kind, data)
+                # --output-dir reproduces the whole tree
+                if kind == "unmatched" and output_folder and not opts.dry_run:
+                    copy_file(f, os.path.join(output_folder, os.path.basename(f)), opts, data)
+    finally:
+        if pipeline and started < len(files):
+            pipeline.discard(files[started:])
+    return
+
+
+def _process_folder(path, opts, func, data, scanner, rules=None):
+    """Process matching files inside <path> folder (potentially recursive).
+
+    `scanner` is the FolderScanner that lists folders (owned by process()).
+    `rules` is the IgnoreRules stack of the parent folder (--use-ignore-files).
+    """
     assert opts.match_list
     assert os.path.isdir(path)
     assert not opts.target_path
 
-    data["dirs_processed"] += 1
     try:
-        for name in os.listdir(path):
-            f = os.path.join(path, name)
-            is_file = os.path.isfile(f)
-            # handle --ignore
-            if is_matching(name, opts.ignore_list):
-                if is_file:
-                    data["files_ignored"] += 1
-                else:
-                    data["dirs_ignored"] += 1
+        st, folder_rules, entries = scanner.take(path, rules)
+        # Never enter a folder twice (symlink loops, bind mounts, ...)
+        if not is_first_visit(path, data, "visited_dirs", st):
+            data["dirs_deduplicated"] += 1
+            return
+        data["dirs_processed"] += 1
+        output_folder, changed = _enter_folder(path, opts, data)
+        if changed:
+            st, folder_rules, entries = scanner.take(path, rules, rescan=True)
+        scanner.prefetch(folder_rules, entries)
+        for f in _process_entries(entries, output_folder, opts, func, data):
+            _process_folder(f, opts, func, data, scanner, folder_rules)
+    except Exception as e:
+        if opts.ignore_errors:
+            if opts.verbose >= 1:
+                print("Skipping due to ERROR", e)
+        else:
+            raise
+    return
+
+
+def _process_folders_unordered(path, opts, func, data, scanner):
+    """Process <path> recursively, in the order in which folder listings complete.
+
+    Used by --walk-unordered: the main thread never waits for a specific
+    folder, while all known folders are listed in the thread pool.
+    """
+    assert opts.match_list and opts.recursive
+    assert scanner.pool
+    results = Queue()
+    scanner.submit(path, None, results)
+    outstanding = 1
+    while outstanding:
+        folder, rules, listing, error = results.get()
+        outstanding -= 1
+        try:
+            if error is not None:
+                raise error
+            st, folder_rules, entries = listing
+            if not is_first_visit(folder, data, "visited_dirs", st):
+                data["dirs_deduplicated"] += 1
                 continue
+            data["dirs_processed"] += 1
+            output_folder, changed = _enter_folder(folder, opts, data)
+            if changed:
+                st, folder_rules, entries = scanner.scan(folder, rules)
+            for f in _process_entries(entries, output_folder, opts, func, data):
+                scanner.submit(f, folder_rules, results)
+                outstanding += 1
+        except Exception as e:
+            if opts.ignore_errors:
+                if opts.verbose >= 1:
+                    print("Skipping due to ERROR", e)
+            else:
+                raise
+    return
 
-            if is_file:
-                # handle --match (only applied to files)
-                if opts.match_list and not is_matching(name, opts.match_list):
-                    data["files_ignored"] += 1
-                    continue
-                _process_file(f, opts, func, data)
-            elif opts.recursive:
-                _process_folder(f, opts, func, data)
+
+def _iter_folder(path, opts, data, scanner, rules=None):
+    """Yield the matching files inside <path> folder (see iter_files())."""
+    try:
+        st, folder_rules, entries = scanner.take(path, rules)
+        if not is_first_visit(path, data, "visited_dirs", st):
+            data["dirs_deduplicated"] += 1
+            return
+        data["dirs_processed"] += 1
+        scanner.prefetch(folder_rules, entries)
+        for kind, f in entries:
+            if kind == "file":
+                yield f
+            elif kind == "dir":
+                for fspec in _iter_folder(f, opts, data, scanner, folder_rules):
+                    yield fspec
+            else:
+                _count_skipped_entry(kind, data)
     except Exception as e:
         if opts.ignore_errors:
             if opts.verbose >= 1:
@@ -180,46 +1064,165 @@ def _process_folder(path, opts, func, data):
     return
 
 
-def process(args, opts, func, data):
+def iter_files(args, opts, data, list_func=None):
+    """Yield the files in args that process() would visit, in the same order.
+
+    Nothing is modified: no temp files, journal, backups, or --output-dir tree.
+    The walker counters in `data` (dirs_processed, files_ignored,
+    files_deduplicated, ...) are updated like process() does. Files that are
+    rejected per file (--ignore, binary extensions) are yielded nevertheless.
+    Only the first name of a hardlinked file is yielded: call
+    relink_hardlinks() after the files were processed.
+    Folders are always walked in order (--walk-unordered is not supported).
+    """
+    _init_data(data)
+    scanner = FolderScanner(opts, list_func)
+    try:
+        if opts.recursive or opts.match_list:
+            if not opts.recursive:
+                assert len(args) == 1
+            files = (f for path in args for f in _iter_folder(path, opts, data, scanner))
+        else:
+            files = iter(args)
+        for fspec in files:
+            # Process every physical file only once (see _process_file_stages())
+            if not opts.output_path and not _visit_file(os.path.abspath(fspec), data):
+                data["files_deduplicated"] += 1
+                continue
+            yield fspec
+    finally:
+        scanner.close()
+    return
+
+
+def _init_data(data):
+    """Initialize the counters and state used by the walker."""
     data.setdefault("elapsed", 0)
     data.setdefault("elapsed_string", "n.a.")
     data.setdefault("files_processed", 0)
     data.setdefault("files_modified", 0)
     data.setdefault("files_skipped", 0)  # rejected by processor (e.g. binary or empty files)
-    data.setdefault("files_ignored", 0)  # due to --match or --ignore
+    data.setdefault("files_ignored", 0)  # due to --match, --ignore, or ignore files
     data.setdefault("dirs_processed", 0)
-    data.setdefault("dirs_ignored", 0)  # due to --ignore
+    data.setdefault("dirs_ignored", 0)  # due to --ignore or ignore files
+    data.setdefault("files_deduplicated", 0)  # hardlinks or symlinks to visited files
+    data.setdefault("files_relinked", 0)  # other names of replaced hardlinked files
+    data.setdefault("dirs_deduplicated", 0)  # symlink loops or already visited folders
+    data.setdefault("links_skipped", 0)  # due to --skip-symlinks
     data.setdefault("lines_processed", 0)
     data.setdefault("lines_modified", 0)
     data.setdefault("bytes_read", 0)
     data.setdefault("bytes_written", 0)   # count 0 for unmodified files
     data.setdefault("bytes_written_if", 0)  # count full bytes for unmodified files
     data.setdefault("exceptions", 0)
+    data.setdefault("fsync_calls", 0)  # due to --durability
+    data.setdefault("pending_commits", [])  # due to --durability batch
+    data.setdefault("files_resumed", 0)  # finished by a previous run (--journal)
+    data.setdefault("files_recovered", 0)  # interrupted replacement was completed
+    data.setdefault("files_rolled_back", 0)  # interrupted replacement was discarded
+    data.setdefault("journal_done", set())
+    data.setdefault("journal_pending", [])
+    data.setdefault("files_copied", 0)  # unmodified files copied to --output-dir
+    data.setdefault("files_linked", 0)  # unmodified files hardlinked to --output-dir
+    data.setdefault("bytes_copied", 0)
+    data.setdefault("files_read_ahead", 0)  # content was read by --read-ahead threads
+    data.setdefault("bytes_read_ahead", 0)
+    data.setdefault("files_advised", 0)  # exceeded --read-ahead-mb: announced to the OS
+    return data
+
+
+def process(args, opts, func, data, list_func=None):
+    """Call func(fspec, temp_fspec, opts, data) for every matching file in args.
+
+    `temp_fspec` is None if nothing must be written (opts.read_only, or
+    --output-dir in dry-run mode): the processor only reports its results.
+
+    `list_func` replaces list_folder() to list folders.
+    """
+    _init_data(data)
+
+    zip_parts = []
+    if opts.journal_path:
+        zip_parts = _open_journal(opts, data)
 
     if opts.zip_backup:
         zip_folder = os.path.abspath(args[0])
         assert os.path.isdir(zip_folder)
-        zip_fspec = os.path.join(
-            zip_folder, "backup_{}.zip".format(datetime.now().strftime("%Y%m%d-%H%M%S")))
+        for zip_fspec in zip_parts:
+            # Killed before the part was closed: the backups are only
+            # recoverable by repairing the archive
+            if os.path.exists(zip_fspec) and not is_zipfile(zip_fspec) and opts.verbose >= 1:
+                print("WARNING: backup archive is not readable (interrupted run), "
+                      "repair it with `zip -FF`: %s" % zip_fspec)
+        if zip_parts:
+            # Resume: add new parts to the archive of the previous run
+            zip_base = os.path.splitext(zip_parts[0])[0]
+        else:
+            # Never overwrite an existing archive
+            zip_name = "backup_{}".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+            zip_base = os.path.join(zip_folder, zip_name)
+            i = 1
+            while os.path.exists(zip_base + ".zip"):
+                i += 1
+                zip_base = os.path.join(zip_folder, "%s_%d" % (zip_name, i))
         data["zipfile_folder"] = zip_folder
-        data["zipfile_fspec"] = zip_fspec
-    start = time.clock()
-
-    if opts.recursive:
-        for path in args:
-            _process_folder(path, opts, func, data)
-    elif opts.match_list:
-        assert len(args) == 1
-#        data["dirs_processed"] += 1
-        _process_folder(args[0], opts, func, data)
-    else:
-        for f in args:
-            _process_file(f, opts, func, data)
+        data["zipfile_base"] = zip_base
+        data["zipfile_parts"] = zip_parts
 
-    if data.get("zipfile"):
-        data["zipfile"].close()
+    if opts.output_path:
+        assert len(args) == 1 and os.path.isdir(args[0])
+        assert not opts.target_path and not opts.zip_backup
+        data["output_root"] = (os.path.abspath(args[0]), os.path.abspath(opts.output_path))
+    reporter = None
+    if opts.progress:
+        # (Imported here, because tabfix.progress depends on this module)
+        from tabfix.progress import ProgressReporter
+        reporter = ProgressReporter(args, opts, data).start()
+    start = _timer()
 
-    data["elapsed"] = time.clock() - start
+    scanner = FolderScanner(opts, list_func)
+    pipeline = commit_error = None
+    if opts.read_ahead > 0 or opts.write_behind > 0:
+        pipeline = data["pipeline"] = FilePipeline(opts)
+    try:
+        if opts.recursive:
+            for path in args:
+                if scanner.pool and not opts.walk_ordered:
+                    _process_folders_unordered(path, opts, func, data, scanner)
+                else:
+                    _process_folder(path, opts, func, data, scanner)
+        elif opts.match_list:
+            assert len(args) == 1
+#            data["dirs_processed"] += 1
+            _process_folder(args[0], opts, func, data, scanner)
+        else:
+            if pipeline:
+                pipeline.schedule(args)
+            for f in args:
+                _process_file(f, opts, func, data)
+    finally:
+        scanner.close()
+        if pipeline:
+            # Commits must be complete before the journal is flushed
+            commit_error = pipeline.close(data)
+            data.pop("pipeline")
+        # Temp files of processed files are complete, so commit them even on errors
+        flush_commits(opts, data)
+        flush_journal(opts, data)
+        if data.get("journal"):
+            data["journal"].close()
+        if data.get("zipfile"):
+            data["zipfile"].close()
+        if reporter:
+            reporter.stop()
+    if commit_error is not None:
+        if not opts.ignore_errors:
+            raise commit_error
+        if opts.verbose >= 1:
+            print("Skipping due to ERROR", commit_error)
+    relink_hardlinks(opts, data)
+
+    data["elapsed"] = _timer() - start
     data["elapsed_string"] = "%.3f sec" % data["elapsed"]
 
 #    if opts.dry_run and opts.verbose >= 1:
@@ -249,6 +1252,18 @@ def add_common_options(parser):
                       action="append", dest="ignore_list",
                       help="skip this file or folder name patterns "
                             "(separate by ',' or repeat this option)")
+    parser.add_option("", "--use-ignore-files",
+                      action="store_true", dest="use_ignore_files", default=False,
+                      help="skip files and folders listed in .gitignore or .tabfixignore "
+                           "files of visited folders")
+    parser.add_option("", "--binary-ext",
+                      action="append", dest="binary_extensions",
+                      help="skip files with this extension without opening them "
+                           "(separate by ',' or repeat this option)")
+    parser.add_option("", "--text-ext",
+                      action="append", dest="text_extensions",
+                      help="treat files with this extension as text, unless they "
+                           "contain NUL bytes (separate by ',' or repeat this option)")
     parser.add_option("-r", "--recursive",
                       action="store_true", dest="recursive", default=False,
                       help="visit sub directories")
@@ -256,12 +1271,73 @@ def add_common_options(parser):
                       action="store", dest="target_path", default=None,
                       metavar="FILENAME",
                       help="name of output file")
+    parser.add_option("", "--output-dir",
+                      action="store", dest="output_path", default=None,
+                      metavar="DIR",
+                      help="don't modify the source folder, but write a copy of the "
+                           "tree to DIR (unmodified files are copied unchanged)")
+    parser.add_option("", "--output-link",
+                      action="store_true", dest="output_link", default=False,
+                      help="hardlink unmodified files to the --output-dir tree "
+                           "instead of copying them")
     parser.add_option("-b", "--backup",
                       action="store_true", dest="backup", default=False,
                       help="create backup files (*.bak)")
     parser.add_option("", "--zip-backup",
                       action="store_true", dest="zip_backup", default=False,
                       help="add backups of modified files to a zip-file (implies -b)")
+    parser.add_option("", "--journal",
+                      action="store", dest="journal_path", default=None,
+                      metavar="FILENAME",
+                      help="record finished files in FILENAME, so an interrupted run "
+                           "can be resumed (re-run with the same options)")
+    parser.add_option("", "--journal-batch",
+                      action="store", dest="journal_batch", type="int", default=100,
+                      metavar="N",
+                      help="with --journal: record finished files in groups of N "
+                           "(default: %default)")
+    parser.add_option("", "--durability",
+                      action="store", dest="durability", type="choice",
+                      choices=DURABILITY_MODES, default="none", metavar="MODE",
+                      help="flush modified files to disk before replacing the originals: "
+                           "'none', 'file' (fsync every file), or 'batch' (sync and "
+                           "replace files in groups; default: %default)")
+    parser.add_option("", "--durability-batch",
+                      action="store", dest="durability_batch", type="int", default=500,
+                      metavar="N",
+                      help="with --durability batch: replace up to N files per "
+                           "group (default: %default)")
+    parser.add_option("", "--skip-symlinks",
+                      action="store_false", dest="follow_symlinks", default=True,
+                      help="don't follow symbolic links to files or folders")
+    parser.add_option("", "--walk-threads",
+                      action="store", dest="walk_threads", type="int", default=0,
+                      metavar="N",
+                      help="list folders ahead of time in N threads (speeds up "
+                           "network or FUSE file systems; default: off)")
+    parser.add_option("", "--walk-unordered",
+                      action="store_false", dest="walk_ordered", default=True,
+                      help="with --walk-threads: process folders as soon as they are "
+                           "listed, instead of in depth-first order")
+    parser.add_option("", "--read-ahead",
+                      action="store", dest="read_ahead", type="int", default=0,
+                      metavar="N",
+                      help="read up to N files ahead in background threads, while "
+                           "the current file is transformed (default: off)")
+    parser.add_option("", "--read-ahead-mb",
+                      action="store", dest="read_ahead_mb", type="int", default=64,
+                      metavar="MB",
+                      help="with --read-ahead: limit the buffered content to MB "
+                           "megabytes (default: %default)")
+    parser.add_option("", "--write-behind",
+                      action="store", dest="write_behind", type="int", default=0,
+                      metavar="N",
+                      help="replace up to N modified files in background threads "
+                           "(default: off)")
+    parser.add_option("", "--progress",
+                      action="store_true", dest="progress", default=False,
+                      help="display a status line with throughput and ETA on stderr "
+                           "(limits verbosity to 2)")
     parser.add_option("", "--ignore-errors",
                       action="store_true", dest="ignore_errors", default=False,
                       help="ignore errors during processing")
@@ -293,6 +1369,12 @@ def check_common_options(parser, options, args):
                     match_list.append(pattern)
         options.ignore_list = match_list
 
+    # allow multiple extensions in one --binary-ext or --text-ext option
+    for name in ("binary_extensions", "text_extensions"):
+        if getattr(options, name):
+            setattr(options, name, [ext for exts in getattr(options, name)
+                                    for ext in exts.split(",")])
+
     # TODO:
 #    if options.quiet and options.verbose:
 #        parser.error("options -q and -v are mutually exclusive")
@@ -304,6 +1386,10 @@ def check_common_options(parser, options, args):
         options.verbose = max(0, options.verbose - options.verboseDecrement)
     del options.verboseDecrement
 
+    # --progress replaces the per-file output
+    if options.progress:
+        options.verbose = min(options.verbose, 2)
+
     # --zip-backup implies -b
     if options.zip_backup:
         options.backup = True
@@ -340,9 +1426,38 @@ def check_common_options(parser, options, args):
         parser.error("--zip-backup and --no-backup are mutually exclusive")
     elif options.zip_backup and (len(args) != 1 or not os.path.isdir(args[0])):
         parser.error("--zip-backup requires exactly one source directory")
+
+    if options.durability_batch < 1 or options.journal_batch < 1:
+        parser.error("--durability-batch and --journal-batch must be at least 1")
+
+    if options.read_ahead < 0 or options.write_behind < 0 or options.read_ahead_mb < 0:
+        parser.error("--read-ahead, --read-ahead-mb, and --write-behind must not be negative")
+    options.read_ahead_bytes = options.read_ahead_mb * 1024 * 1024
+    # Not a command line option (set by read-only modes like --scan)
+    options.read_only = False
+    if options.write_behind and options.durability == "batch":
+        parser.error("--write-behind cannot be combined with --durability batch")
+
+    if options.output_path:
+        if options.target_path or options.backup:
+            parser.error("--output-dir cannot be combined with -o, -b, or --zip-backup")
+        elif len(args) != 1 or not os.path.isdir(args[0]):
+            parser.error("--output-dir requires exactly one source directory")
+        elif (_is_inside(options.output_path, args[0])
+              or _is_inside(args[0], options.output_path)):
+            parser.error("--output-dir and the source directory must not overlap")
+    elif options.output_link:
+        parser.error("--output-link requires --output-dir")
     return True
 
 
+def _is_inside(path, folder):
+    """Return True if <path> is <folder> or located below it."""
+    path = os.path.normcase(os.path.realpath(path))
+    folder = os.path.normcase(os.path.realpath(folder))
+    return path == folder or path.startswith(os.path.join(folder, ""))
+
+
 # ==============================================================================
 # Sample processor
 # ==============================================================================
@@ -0,0 +1,170 @@
+# (c) 2010, 2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Classify files as text or binary.
+
+1. Files with a known binary extension are rejected without being opened.
+2. Otherwise the first block of the file is sniffed:
+   - a UTF-8, UTF-16, or UTF-32 BOM marks a text file
+   - a known magic number (PNG, ZIP, PDF, ELF, ...) marks a binary file
+     (not checked for known text extensions)
+   - a NUL byte marks a binary file
+   - anything else is text
+
+The extension tables can be extended with --binary-ext and --text-ext.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import codecs
+import os
+
+
+DEFAULT_BINARY_EXTENSIONS = frozenset((
+    ".7z", ".a", ".apk", ".avi", ".bin", ".bmp", ".bz2", ".class", ".dll",
+    ".dmg", ".doc", ".docx", ".dylib", ".eot", ".exe", ".flac", ".gif", ".gz",
+    ".ico", ".jar", ".jpeg", ".jpg", ".lib", ".mkv", ".mov", ".mp3", ".mp4",
+    ".o", ".obj", ".odp", ".ods", ".odt", ".ogg", ".otf", ".pdf", ".png",
+    ".ppt", ".pptx", ".psd", ".pyc", ".pyd", ".pyo", ".rar", ".so", ".sqlite",
+    ".tar", ".tgz", ".tif", ".tiff", ".ttf", ".wav", ".webm", ".webp", ".whl",
+    ".woff", ".woff2", ".xls", ".xlsx", ".xz", ".zip", ".zst",
+    ))
+
+DEFAULT_TEXT_EXTENSIONS = frozenset((
+    ".bat", ".c", ".cfg", ".cmd", ".cpp", ".cs", ".css", ".csv", ".go", ".h",
+    ".hpp", ".htm", ".html", ".ini", ".java", ".js", ".json", ".jsx", ".less",
+    ".md", ".php", ".pl", ".py", ".rb", ".rs", ".rst", ".scss", ".sh", ".sql",
+    ".svg", ".toml", ".ts", ".tsx", ".txt", ".xml", ".yaml", ".yml",
+    ))
+
+# (offset, signature) of common binary formats that may not contain a NUL
+# byte in the first block
+MAGIC_NUMBERS = (
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (0, b"GIF87a"),
+    (0, b"GIF89a"),
+    (0, b"\xff\xd8\xff"),  # JPEG
+    (0, b"%PDF-"),
+    (0, b"PK\x03\x04"),  # ZIP, JAR, Office documents
+    (0, b"PK\x05\x06"),  # Empty ZIP
+    (0, b"\x1f\x8b"),  # gzip
+    (4, b"1AY&SY"),  # bzip2
+    (0, b"\xfd7zXZ\x00"),
+    (0, b"7z\xbc\xaf\x27\x1c"),
+    (0, b"Rar!\x1a\x07"),
+    (0, b"\x28\xb5\x2f\xfd"),  # zstd
+    (0, b"\x7fELF"),
+    (0, b"\xca\xfe\xba\xbe"),  # Java class, Mach-O universal binary
+    (0, b"\xcf\xfa\xed\xfe"),  # Mach-O
+    (0, b"\xce\xfa\xed\xfe"),  # Mach-O
+    (0, b"SQLite format 3\x00"),
+    (0, b"OggS"),
+    (0, b"fLaC"),
+    (0, b"wOFF"),
+    (0, b"wOF2"),
+    (4, b"ftyp"),  # MP4, MOV
+    )
+
+# Byte order marks and the codec of the following text (None: no transcoding
+# needed). UTF-32 must be tested first: its LE BOM starts with the UTF-16 LE BOM.
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, None),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+    )
+
+
+def get_bom(encoding):
+    """Return the byte order mark that is written before text in <encoding>."""
+    for bom, name in BOMS:
+        if name == encoding:
+            return bom
+    raise ValueError("Unsupported encoding: %r" % encoding)
+
+
+def normalize_extensions(extensions):
+    """Return a set of lower case extensions with leading dot ('*.PNG' -> '.png')."""
+    res = set()
+    for ext in extensions or ():
+        ext = ext.strip().lstrip("*").lower()
+        if ext:
+            res.add(ext if ext.startswith(".") else "." + ext)
+    return res
+
+
+def classify_buffer(buf, check_magic=True):
+    """Return an (is_text, reason, encoding) tuple for the first block of a file.
+
+    `reason` is one of 'text_bom', 'binary_magic', 'binary_nul', 'text_sniff'.
+    `encoding` is the codec of a UTF-16 or UTF-32 file, or None.
+    """
+    for bom, encoding in BOMS:
+        if buf.startswith(bom):
+            return True, "text_bom", encoding
+    if check_magic:
+        for offset, signature in MAGIC_NUMBERS:
+            if buf[offset:offset + len(signature)] == signature:
+                return False, "binary_magic", None
+    if b"\0" in buf:
+        return False, "binary_nul", None
+    return True, "text_sniff", None
+
+
+# FileClassifier instances by extension options (see get_classifier())
+_classifiers = {}
+
+
+def get_classifier(opts):
+    """Return a FileClassifier for the --binary-ext and --text-ext options."""
+    key = (tuple(opts.binary_extensions or ()), tuple(opts.text_extensions or ()))
+    classifier = _classifiers.get(key)
+    if classifier is None:
+        classifier = FileClassifier(opts.binary_extensions, opts.text_extensions)
+        _classifiers[key] = classifier
+    return classifier
+
+
+# ==============================================================================
+# FileClassifier
+# ==============================================================================
+class FileClassifier(object):
+    """Decide whether a file is text, using extension tables and its first block.
+
+    Extensions passed as `text_extensions` take precedence over the default
+    binary extensions and vice versa.
+    """
+    def __init__(self, binary_extensions=None, text_extensions=None, blocksize=512):
+        binary_extensions = normalize_extensions(binary_extensions)
+        text_extensions = normalize_extensions(text_extensions)
+        self.binary_extensions = ((DEFAULT_BINARY_EXTENSIONS - text_extensions)
+                                  | binary_extensions)
+        self.text_extensions = ((DEFAULT_TEXT_EXTENSIONS - binary_extensions)
+                                | text_extensions)
+        self.blocksize = blocksize
+
+    def is_binary_name(self, fspec):
+        """Return True if <fspec> has a known binary extension (no I/O)."""
+        return os.path.splitext(fspec)[1].lower() in self.binary_extensions
+
+    def sniff(self, fspec, content=None):
+        """Return an (is_text, reason, encoding) tuple (see classify_buffer()).
+
+        Files with a known text extension are still checked for BOMs and NUL
+        bytes and report 'text_extension' instead of 'text_sniff'.
+        Pass `content` if the file was already read.
+        """
+        is_text_ext = os.path.splitext(fspec)[1].lower() in self.text_extensions
+        if content is not None:
+            buf = content[:self.blocksize]
+        else:
+            try:
+                with open(fspec, "rb") as f:
+                    buf = f.read(self.blocksize)
+            except IOError:
+                return False, "binary_unreadable", None
+        res = classify_buffer(buf, check_magic=not is_text_ext)
+        if is_text_ext and res[1] == "text_sniff":
+            return True, "text_extension", None
+        return res
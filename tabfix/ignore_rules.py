@@ -0,0 +1,158 @@
+# (c) 2010, 2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Support for hierarchical ignore files (.gitignore syntax).
+
+Every visited folder may contain a `.gitignore` and/or `.tabfixignore` file.
+The rules of a folder are compiled once and pushed on top of the rules of its
+parent folders, so deeper rules take precedence (the last matching pattern
+wins, a leading '!' negates a pattern).
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import re
+
+
+IGNORE_FILE_NAMES = (".gitignore", ".tabfixignore")
+
+# Match case-insensitively on case-insensitive file systems (Windows)
+_RE_FLAGS = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+
+
+def _translate_segment(seg):
+    """Convert one path segment of a glob pattern to a regular expression."""
+    i, n = 0, len(seg)
+    res = []
+    while i < n:
+        c = seg[i]
+        i += 1
+        if c == "*":
+            res.append("[^/]*")
+            while i < n and seg[i] == "*":
+                i += 1
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            j = i
+            if j < n and seg[j] in "!^":
+                j += 1
+            if j < n and seg[j] == "]":
+                j += 1
+            while j < n and seg[j] != "]":
+                j += 1
+            if j >= n:
+                res.append("\\[")
+            else:
+                stuff = seg[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if stuff[0] in "!^":
+                    stuff = "^" + stuff[1:]
+                res.append("[%s]" % stuff)
+        elif c == "\\" and i < n:
+            res.append(re.escape(seg[i]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+    return "".join(res)
+
+
+def compile_rule(line):
+    """Return a (regex, negate, dir_only) tuple for a .gitignore line.
+
+    Return None for blank lines and comments.
+    The regex matches paths relative to the folder of the ignore file, using
+    '/' as separator.
+    """
+    line = line.rstrip("\r\n")
+    # Trailing spaces are ignored, unless escaped with a backslash
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+    if not line or line.startswith("#"):
+        return None
+
+    negate = False
+    if line.startswith("!"):
+        negate = True
+        line = line[1:]
+    elif line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # Patterns that contain a slash are relative to the ignore file's folder,
+    # otherwise they match a name at any level below it
+    anchored = "/" in line
+    line = line.lstrip("/")
+
+    parts = []
+    segments = line.split("/")
+    for i, seg in enumerate(segments):
+        is_last = (i == len(segments) - 1)
+        if seg == "**":
+            parts.append(".*" if is_last else "(?:.*/)?")
+        else:
+            parts.append(_translate_segment(seg))
+            if not is_last:
+                parts.append("/")
+    pattern = "".join(parts)
+    if not anchored:
+        pattern = "(?:.*/)?" + pattern
+    return re.compile(pattern + r"\Z", _RE_FLAGS), negate, dir_only
+
+
+def read_ignore_file(fspec):
+    """Return a list of compiled rules from a .gitignore-style file."""
+    with open(fspec, "rb") as f:
+        text = f.read().decode("utf-8", "replace")
+    rules = []
+    for line in text.splitlines():
+        rule = compile_rule(line)
+        if rule:
+            rules.append(rule)
+    return rules
+
+
+# ==============================================================================
+# IgnoreRules
+# ==============================================================================
+class IgnoreRules(object):
+    """Immutable stack of compiled ignore rules, one level per folder.
+
+    Call `enter(folder)` when descending into a folder to get the rules that
+    apply there. Folders without ignore files share their parent's stack.
+    """
+    def __init__(self, levels=()):
+        # Tuple of (folder prefix, [(regex, negate, dir_only), ...])
+        self.levels = tuple(levels)
+
+    def enter(self, folder, file_names=IGNORE_FILE_NAMES):
+        """Return the rule stack for <folder> (including its own ignore files)."""
+        rules = []
+        for name in file_names:
+            fspec = os.path.join(folder, name)
+            if os.path.isfile(fspec):
+                rules.extend(read_ignore_file(fspec))
+        if not rules:
+            return self
+        prefix = os.path.join(folder, "")
+        return IgnoreRules(self.levels + ((prefix, rules), ))
+
+    def is_ignored(self, fspec, is_dir):
+        """Return True if <fspec> (a direct child of the last entered folder) is ignored."""
+        ignored = False
+        for prefix, rules in self.levels:
+            rel_path = fspec[len(prefix):]
+            if os.sep != "/":
+                rel_path = rel_path.replace(os.sep, "/")
+            for regex, negate, dir_only in rules:
+                if dir_only and not is_dir:
+                    continue
+                if regex.match(rel_path):
+                    ignored = not negate
+        return ignored
@@ -12,13 +12,25 @@ Cleanup whitespace in text files:
 from __future__ import print_function
 from __future__ import absolute_import
 
+import io
+import json
+import mmap
+import multiprocessing
 from optparse import OptionParser
 import os
 from tabfix.cmd_walker import WalkerOptions, add_common_options, check_common_options,\
-    process, is_text_file, increment_data
+    get_prefetched, process, increment_data
+from tabfix.file_types import get_bom, get_classifier
+from tabfix.profiling import can_trace_memory, profile_process
+from tabfix.result_cache import ResultCache
 from tabfix._version import __version__
 import sys
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 IS_PY2 = sys.version_info[0] < 3
 IS_PY3 = not IS_PY2
@@ -36,6 +48,15 @@ _SEPARATOR_MAP = {
     "WINDOWS": DELIM_CRLF,
     }
 
+# Available values for --engine
+ENGINES = ("python", "numpy")
+
+# Minimum chunk size when splitting large files (see --split-threshold)
+SPLIT_MIN_CHUNK_SIZE = 1024 * 1024
+
+# The NumPy engine processes files in blocks of this size (bounds its index arrays)
+NUMPY_BLOCK_SIZE = 1024 * 1024
+
 
 class Opts(WalkerOptions):
     """Options object, may be used instead of command line args."""
@@ -45,6 +66,10 @@ class Opts(WalkerOptions):
         self.inputTabSize = None
         self.tabbify = False
         self.lineSeparator = None
+        self.engine = "python"
+        self.planner = True
+        self.splitThreshold = None
+        self.splitWorkers = None
 
 
 def _hex_string(s):
@@ -79,29 +104,36 @@ def read_text_lines(fname, newline_dict=None):
     # Don't use 'U': (default in Python 3), but would replace line endings
     # with `\n` Python 2
     with open(fname, "rb") as f:
-        for line in f.readlines():
-            ending = b""
-            if line.endswith(DELIM_CRLF):
-                ending = DELIM_CRLF
-                newline_dict[DELIM_CRLF] += 1
-            elif line.endswith(DELIM_CR):
-                ending = DELIM_CR
-                newline_dict[DELIM_CR] += 1
-            elif line.endswith(DELIM_LF):
-                ending = DELIM_LF
-                newline_dict[DELIM_LF] += 1
-            # Strip all trailing `\r` and/or `\n`
-            line = line.rstrip(DELIM_CRLF)
-            # Handle `\r` (Mac, CR) separators, as they are not recognized by python 3
-            count_lf = line.count(DELIM_CR)
-            if count_lf > 0:
-                newline_dict[DELIM_CR] += count_lf
-                l2 = [l + DELIM_CR for l in line.split(DELIM_CR)]
-            else:
-                l2 = [line + ending]
+        for line in _split_lines(f.readlines(), newline_dict):
+            yield line
+    return
+
+
+def _split_lines(raw_lines, newline_dict):
+    """Split the result of readlines() at `\r` and count line endings."""
+    for line in raw_lines:
+        ending = b""
+        if line.endswith(DELIM_CRLF):
+            ending = DELIM_CRLF
+            newline_dict[DELIM_CRLF] += 1
+        elif line.endswith(DELIM_CR):
+            ending = DELIM_CR
+            newline_dict[DELIM_CR] += 1
+        elif line.endswith(DELIM_LF):
+            ending = DELIM_LF
+            newline_dict[DELIM_LF] += 1
+        # Strip all trailing `\r` and/or `\n`
+        line = line.rstrip(DELIM_CRLF)
+        # Handle `\r` (Mac, CR) separators, as they are not recognized by python 3
+        count_lf = line.count(DELIM_CR)
+        if count_lf > 0:
+            newline_dict[DELIM_CR] += count_lf
+            l2 = [l + DELIM_CR for l in line.split(DELIM_CR)]
+        else:
+            l2 = [line + ending]
 
-            for l in l2:
-                yield l
+        for l in l2:
+            yield l
     return
 
 
@@ -109,6 +141,498 @@ def read_text_lines(fname, newline_dict=None):
 # fix_tabs
 # ==============================================================================
 
+def _fix_indent(line, tabSize, inputTabSize, tabbify):
+    """Return a line (without ending) with unified indentation and no trailing whitespace."""
+    # TODO: add shift-space
+    line = line.rstrip(b" \t")
+    indent = 0
+    chars = 0
+    for c in line:
+        # Python 3 returns int, Python 2 returns str
+        if IS_PY2:
+            c = ord(c)
+        if c in (32, 160):  # Space, shift-space
+            chars += 1
+            indent += 1
+        elif c == 9:  # TAB
+            chars += 1
+            # Use integer division '//' (Py3k)
+            indent = inputTabSize * ((indent + inputTabSize) // inputTabSize)
+        else:
+            break
+
+    if tabbify:
+        # Use '//' integer division (Py3k)
+        return b"\t" * (indent // tabSize) + b" " * (indent % tabSize) + line[chars:]
+    return b" " * indent + line[chars:]
+
+
+def _get_line_separator(opts, stats):
+    """Return (source_line_separator, line_separator) for the given line ending stats."""
+    # Line delimiter of input file (`None` if ambiguous)
+    ending_types = []
+#    max_ending_type = None
+#    max_ending_count = 0
+    for type_, count in stats.items():
+        if count:
+            ending_types.append(type_)
+#        if count > max_ending_count:
+#            max_ending_type = type_
+    if len(ending_types) == 1:
+        source_line_separator = ending_types[0]
+    else:
+        source_line_separator = None
+
+    if opts.lineSeparator:
+        line_separator = _SEPARATOR_MAP[opts.lineSeparator.upper()]
+    elif source_line_separator:
+        line_separator = source_line_separator
+    else:
+        line_separator = os.linesep
+        if IS_PY3:
+            line_separator = line_separator.encode("ascii")
+    assert type(line_separator) is type(b"")  # noqa E721
+
+    if source_line_separator != line_separator and opts.verbose >= 4:
+        print("    Changing line separator to %s" % (_hex_string(line_separator)))
+    return source_line_separator, line_separator
+
+
+def _fix_lines(lines, stats, opts):
+    """Transform an iterator of binary lines (the reference implementation).
+
+    `stats` is updated by the iterator (see read_text_lines()).
+    Return a tuple (modified, chunks, line_count, changed_lines), where `chunks`
+    is a list of binary strings that make up the output file.
+    """
+    inputTabSize = opts.inputTabSize or opts.tabSize
+
+    modified = False
+    res = []
+    line_no = 0
+    changed_lines = 0
+    for line in lines:
+        line_no += 1
+        # Note: this strips '\r' and/or '\n'
+        org_line = line.rstrip(DELIM_CRLF)
+        s = _fix_indent(org_line, opts.tabSize, inputTabSize, opts.tabbify)
+
+        res.append(s)
+        if s != org_line:
+            modified = True
+            changed_lines += 1
+            if opts.verbose >= 5:
+                print("        #%04i: %s" % (line_no, org_line.replace(b" ", b".").replace(b"\t", b"<tab>")))
+                print("             : %s" % s.replace(b" ", b".").replace(b"\t", b"<tab>"))
+
+    source_line_separator, line_separator = _get_line_separator(opts, stats)
+    if source_line_separator != line_separator:
+        modified = True
+    # Strip trailing empty lines
+    while len(res) > 1 and res[-1] == b"":
+        modified = True
+        res.pop()
+
+    return modified, [line_separator.join(res), line_separator], len(res), changed_lines
+
+
+# ===============================================================================
+# Split large files into chunks that are processed in parallel
+# ==============================================================================
+
+def _find_line_boundary(buf, pos, size):
+    """Return the start of the first line at or behind `pos`.
+
+    Only split behind `\n` or behind a single `\r` that is neither preceeded
+    nor followed by `\r` or `\n`, so every chunk produces the same lines and
+    line ending stats as read_text_lines() does for the complete file.
+    """
+    if pos >= size:
+        return size
+    lf = buf.find(DELIM_LF, pos, size)
+    limit = size if lf < 0 else lf
+    cr = buf.find(DELIM_CR, pos, limit)
+    while cr >= 0:
+        if (buf[cr - 1:cr] not in (DELIM_CR, DELIM_LF)
+                and buf[cr + 1:cr + 2] not in (DELIM_CR, DELIM_LF)):
+            return cr + 1
+        cr = buf.find(DELIM_CR, cr + 1, limit)
+    if lf < 0:
+        return size
+    return lf + 1
+
+
+def _find_chunk_bounds(buf, chunk_size):
+    """Return a list of (start, end) tuples that split `buf` at line boundaries."""
+    size = len(buf)
+    bounds = []
+    start = 0
+    while start < size:
+        end = _find_line_boundary(buf, start + chunk_size, size)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def _fix_chunk(args):
+    """Transform one chunk of a memory-mapped file (runs in a worker process).
+
+    Return a tuple (text, line_count, changed_lines, stats), where `text` is
+    the transformed lines joined by `\n`.
+    """
+    fspec, start, end, tabSize, inputTabSize, tabbify = args
+    with open(fspec, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = mm[start:end]
+        finally:
+            mm.close()
+
+    stats = {DELIM_CR: 0, DELIM_LF: 0, DELIM_CRLF: 0}
+    res = []
+    changed_lines = 0
+    for line in _split_lines(io.BytesIO(buf).readlines(), stats):
+        org_line = line.rstrip(DELIM_CRLF)
+        s = _fix_indent(org_line, tabSize, inputTabSize, tabbify)
+        if s != org_line:
+            changed_lines += 1
+        res.append(s)
+    return DELIM_LF.join(res), len(res), changed_lines, stats
+
+
+def create_split_pool(opts):
+    """Return a process pool for --split-threshold (or None for one worker).
+
+    The workers are started by a fork server (or spawned) instead of forking
+    this process, which may be running the --walk-threads, --read-ahead or
+    asyncio executor threads. The caller must close() and join() the pool.
+    """
+    workers = opts.splitWorkers or multiprocessing.cpu_count()
+    if workers < 2:
+        return None
+    if not hasattr(multiprocessing, "get_context"):
+        return multiprocessing.Pool(workers)  # Python 2
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver").Pool(workers)
+    return multiprocessing.get_context("spawn").Pool(workers)
+
+
+def _fix_split(fspec, opts, pool=None):
+    """Transform a large file in parallel chunks (see --split-threshold).
+
+    `pool` is the pool of create_split_pool(); if None, a pool is created
+    for this file only.
+    Return the same tuple as _fix_lines().
+    """
+    inputTabSize = opts.inputTabSize or opts.tabSize
+    workers = opts.splitWorkers or multiprocessing.cpu_count()
+    size = os.path.getsize(fspec)
+    chunk_size = max(SPLIT_MIN_CHUNK_SIZE, size // (4 * workers) + 1)
+
+    with open(fspec, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            bounds = _find_chunk_bounds(mm, chunk_size)
+        finally:
+            mm.close()
+
+    tasks = [(fspec, start, end, opts.tabSize, inputTabSize, opts.tabbify)
+             for start, end in bounds]
+    if workers > 1 and len(tasks) > 1:
+        own_pool = pool is None
+        if own_pool:
+            pool = create_split_pool(opts)
+        try:
+            results = pool.map(_fix_chunk, tasks, 1)
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+    else:
+        results = [_fix_chunk(task) for task in tasks]
+    return _join_chunks(results, opts)
+
+
+def _join_chunks(results, opts):
+    """Stitch the chunks of _fix_chunk() or _fix_numpy_block() back together.
+
+    Return the same tuple as _fix_lines().
+    """
+    parts = []
+    line_count = 0
+    changed_lines = 0
+    stats = {DELIM_CR: 0, DELIM_LF: 0, DELIM_CRLF: 0}
+    for text, count, changed, chunk_stats in results:
+        if count:
+            parts.append(text)
+        line_count += count
+        changed_lines += changed
+        for type_, type_count in chunk_stats.items():
+            stats[type_] += type_count
+    modified = changed_lines > 0
+
+    source_line_separator, line_separator = _get_line_separator(opts, stats)
+    if source_line_separator != line_separator:
+        modified = True
+    # Strip trailing empty lines (may span multiple chunks)
+    while line_count > 1:
+        last = parts[-1]
+        if last == b"":
+            parts.pop()
+            line_count -= 1
+        elif last.endswith(DELIM_LF):
+            stripped = min(len(last) - len(last.rstrip(DELIM_LF)), line_count - 1)
+            parts[-1] = last[:len(last) - stripped]
+            line_count -= stripped
+        else:
+            break
+        modified = True
+
+    chunks = []
+    for text in parts:
+        if line_separator != DELIM_LF:
+            text = text.replace(DELIM_LF, line_separator)
+        chunks.append(text)
+        chunks.append(line_separator)
+    return modified, chunks, line_count, changed_lines
+
+
+# ===============================================================================
+# NumPy engine (optional)
+# ==============================================================================
+
+def _np_ranges(starts, lengths):
+    """Return the index ranges [start, start + length) concatenated into one array."""
+    mask = lengths > 0
+    starts = starts[mask]
+    lengths = lengths[mask]
+    if not len(lengths):
+        return np.empty(0, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    res = np.ones(ends[-1], dtype=np.int64)
+    res[0] = starts[0]
+    res[ends[:-1]] = starts[1:] - (starts[:-1] + lengths[:-1]) + 1
+    return np.cumsum(res)
+
+
+def _fix_numpy(buf, opts):
+    """Transform a file buffer using vectorized NumPy operations (see --engine).
+
+    The buffer is processed in blocks of NUMPY_BLOCK_SIZE (split at line
+    boundaries), because the index arrays take several times the block size.
+    Return the same tuple as _fix_lines() (which is the reference implementation).
+    """
+    results = []
+    for start, end in _find_chunk_bounds(buf, NUMPY_BLOCK_SIZE):
+        a = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start)
+        results.append(_fix_numpy_block(a, opts))
+    return _join_chunks(results, opts)
+
+
+def _fix_numpy_block(a, opts):
+    """Transform a block of lines (a uint8 array, see _fix_numpy()).
+
+    Line bounds, line ending stats, trailing whitespace and indentation widths
+    are computed for all lines at once.
+    Return the same tuple as _fix_chunk().
+    """
+    tabSize = opts.tabSize
+    inputTabSize = opts.inputTabSize or opts.tabSize
+    n = len(a)
+    sentinel = np.array([n], dtype=np.int64)
+
+    # Split into 'pieces' like readlines() does, i.e. behind every `\n`
+    is_cr = (a == 13)
+    lf_pos = np.flatnonzero(a == 10)
+    cr_pos = np.flatnonzero(is_cr)
+    non_cr = np.concatenate((np.flatnonzero(~is_cr), sentinel))
+    piece_end = lf_pos
+    if n and a[-1] != 10:
+        piece_end = np.concatenate((lf_pos, sentinel))
+    # read_text_lines() strips all trailing `\r` and `\n` from a piece
+    k = np.searchsorted(non_cr, piece_end)
+    content_end = np.where(k > 0, non_cr[np.maximum(k - 1, 0)] + 1, 0)
+    # Other `\r` characters separate lines inside a piece
+    next_non_cr = non_cr[np.searchsorted(non_cr, cr_pos)]
+    inner = (next_non_cr < n)
+    inner[inner] = (a[next_non_cr[inner]] != 10)
+    inner_cr = cr_pos[inner]
+
+    n_crlf = int(np.count_nonzero(a[lf_pos[lf_pos > 0] - 1] == 13))
+    stats = {
+        DELIM_CR: len(inner_cr) + int(n > 0 and a[-1] == 13),
+        DELIM_LF: len(lf_pos) - n_crlf,
+        DELIM_CRLF: n_crlf,
+        }
+
+    ends = np.concatenate((inner_cr, content_end))
+    next_starts = np.concatenate((inner_cr + 1, piece_end + 1))
+    order = np.argsort(ends, kind="mergesort")
+    ends = ends[order]
+    starts = np.concatenate((np.zeros(1, dtype=np.int64), next_starts[order][:-1]))
+
+    # Strip trailing spaces and tabs
+    is_tab = (a == 9)
+    non_ws = np.flatnonzero(~(is_tab | (a == 32)))
+    k = np.searchsorted(non_ws, ends) - 1
+    last = non_ws[np.maximum(k, 0)] if len(non_ws) else np.zeros_like(k)
+    text_end = np.where((k >= 0) & (last >= starts), last + 1, starts)
+
+    # Leading run of spaces, shift-spaces, and tabs
+    non_lead = np.concatenate((np.flatnonzero(~(is_tab | (a == 32) | (a == 160))), sentinel))
+    lead_end = np.minimum(non_lead[np.searchsorted(non_lead, starts)], text_end)
+    run = lead_end - starts
+    tab_pos = np.flatnonzero(is_tab)
+    n_tabs = np.searchsorted(tab_pos, lead_end) - np.searchsorted(tab_pos, starts)
+    nbsp_pos = np.flatnonzero(a == 160)
+    n_nbsp = np.searchsorted(nbsp_pos, lead_end) - np.searchsorted(nbsp_pos, starts)
+
+    # Indentation width: trivial for lines without tabs. Otherwise scan the
+    # run up to the last tab column by column (for all affected lines at once)
+    width = run.copy()
+    with_tabs = np.flatnonzero(n_tabs)
+    if len(with_tabs):
+        last_tab = tab_pos[np.searchsorted(tab_pos, lead_end[with_tabs]) - 1]
+        last_ofs = last_tab - starts[with_tabs]
+        order = np.argsort(-last_ofs, kind="mergesort")
+        idx = with_tabs[order]
+        last_ofs = last_ofs[order]
+        idx_starts = starts[idx]
+        neg_ofs = -last_ofs
+        w = np.zeros(len(idx), dtype=np.int64)
+        for col in range(int(last_ofs[0]) + 1):
+            active = np.searchsorted(neg_ofs, -col, side="right")
+            w_active = w[:active]
+            w[:active] = np.where(
+                a[idx_starts[:active] + col] == 9,
+                inputTabSize * ((w_active + inputTabSize) // inputTabSize),
+                w_active + 1)
+        width[idx] = w + (run[idx] - last_ofs - 1)
+
+    if opts.tabbify:
+        n_indent_tabs = width // tabSize
+        n_indent_spaces = width % tabSize
+        front_tabs = (np.searchsorted(tab_pos, np.minimum(starts + n_indent_tabs, lead_end))
+                      - np.searchsorted(tab_pos, starts))
+        unchanged = ((n_nbsp == 0) & (n_tabs == n_indent_tabs)
+                     & (front_tabs == n_indent_tabs)
+                     & (run == n_indent_tabs + n_indent_spaces))
+        indent_len = n_indent_tabs + n_indent_spaces
+    else:
+        unchanged = (n_tabs == 0) & (n_nbsp == 0)
+        indent_len = width
+    unchanged &= (text_end == ends)
+    changed_lines = len(unchanged) - int(np.count_nonzero(unchanged))
+
+    # Assemble the output: indentation, text, and `\n` for every line
+    body_len = text_end - lead_end
+    out_len = indent_len + body_len
+    line_count = len(ends)
+    line_ofs = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(out_len + 1)[:-1]))
+    out = np.full(int(out_len.sum()) + line_count, 32, dtype=np.uint8)
+    if opts.tabbify:
+        out[_np_ranges(line_ofs, n_indent_tabs)] = 9
+    out[_np_ranges(line_ofs + indent_len, body_len)] = a[_np_ranges(lead_end, body_len)]
+    out[line_ofs + out_len] = 10
+
+    return out[:-1].tobytes(), line_count, changed_lines, stats
+
+
+# ===============================================================================
+# Planner: specialized kernels for common cases
+# ==============================================================================
+
+def _fix_planned(buf, opts):
+    """Transform a file buffer with the cheapest kernel that is sufficient.
+
+    A quick byte-level census of `buf` tells if the indentation needs to be
+    touched at all. If not, only line endings and/or trailing whitespace need
+    attention, which is done by whole-buffer operations:
+
+    - 'clean':     nothing to do
+    - 'separator': only convert line endings (bytes.replace)
+    - 'trailing':  also strip trailing whitespace and empty lines
+
+    Return a tuple (kernel_name, result), where `result` is the same tuple as
+    _fix_lines() returns, or None if the general transform is required.
+    """
+    # A `\r` directly before a line ending is swallowed by read_text_lines(),
+    # so the line ending counts below would be wrong
+    if b"\r\r" in buf or b"\xa0" in buf:
+        return "general", None
+    # Would the indentation of any line change?
+    if opts.tabbify:
+        if (opts.inputTabSize or opts.tabSize) != opts.tabSize:
+            return "general", None
+        if (buf.startswith(b" ") or b"\n " in buf or b"\r " in buf or b"\t " in buf):
+            return "general", None
+    elif (buf.startswith(b"\t") or b"\n\t" in buf or b"\r\t" in buf or b" \t" in buf):
+        return "general", None
+
+    n_crlf = buf.count(DELIM_CRLF)
+    stats = {
+        DELIM_CR: buf.count(DELIM_CR) - n_crlf,
+        DELIM_LF: buf.count(DELIM_LF) - n_crlf,
+        DELIM_CRLF: n_crlf,
+        }
+    source_line_separator, line_separator = _get_line_separator(opts, stats)
+    terminated = buf.endswith((DELIM_CR, DELIM_LF))
+
+    has_trailing_whitespace = (
+        buf.endswith((b" ", b"\t"))
+        or b" \n" in buf or b"\t\n" in buf or b" \r" in buf or b"\t\r" in buf)
+    if not has_trailing_whitespace:
+        # Number of line endings behind the last text, i.e. trailing empty lines + 1
+        tail = buf[len(buf.rstrip(b"\r\n")):]
+        tail_crlf = tail.count(DELIM_CRLF)
+        tail_endings = tail.count(DELIM_CR) + tail.count(DELIM_LF) - tail_crlf
+        if tail_endings <= 1:
+            line_count = sum(stats.values()) + (0 if terminated else 1)
+            if source_line_separator == line_separator:
+                return "clean", (False, [], line_count, 0)
+            if source_line_separator:
+                buf = buf.replace(source_line_separator, line_separator)
+            else:
+                buf = buf.replace(DELIM_CRLF, DELIM_LF).replace(DELIM_CR, DELIM_LF)
+                if line_separator != DELIM_LF:
+                    buf = buf.replace(DELIM_LF, line_separator)
+            chunks = [buf] if terminated else [buf, line_separator]
+            return "separator", (True, chunks, line_count, 0)
+
+    # Unify line endings to `\n`, then strip trailing whitespace and empty lines
+    if source_line_separator != DELIM_LF:
+        buf = buf.replace(DELIM_CRLF, DELIM_LF).replace(DELIM_CR, DELIM_LF)
+    changed_lines = 0
+    if has_trailing_whitespace:
+        lines = buf.split(DELIM_LF)
+        stripped = [line.rstrip(b" \t") for line in lines]
+        changed_lines = sum(1 for line, s in zip(lines, stripped) if len(line) != len(s))
+        buf = DELIM_LF.join(stripped)
+    buf = buf.rstrip(DELIM_LF)
+    line_count = buf.count(DELIM_LF) + 1
+    if line_separator != DELIM_LF:
+        buf = buf.replace(DELIM_LF, line_separator)
+    return "trailing", (True, [buf, line_separator], line_count, changed_lines)
+
+
+# ===============================================================================
+# fix_tabs
+# ==============================================================================
+
+def _decode_text(buf, encoding):
+    """Return the text of a UTF-16 or UTF-32 file (after the BOM) as UTF-8."""
+    errors = "strict" if IS_PY2 else "surrogatepass"
+    text = buf[len(get_bom(encoding)):].decode(encoding, errors)
+    return text.encode("utf-8", errors)
+
+
+def _encode_text(chunks, encoding):
+    """Convert UTF-8 chunks back to <encoding> and prepend the BOM."""
+    errors = "strict" if IS_PY2 else "surrogatepass"
+    text = b"".join(chunks).decode("utf-8", errors)
+    return [get_bom(encoding), text.encode(encoding, errors)]
+
+
 def fix_tabs(fspec, target_fspec, opts, data):
     """Unify leading spaces and tabs and strip trailing whitespace.
 
@@ -116,6 +640,8 @@ def fix_tabs(fspec, target_fspec, opts, data):
     - fspec exists
     - targetFSpec does not exist.
       In replace mode, a targetFSpec is a temp file.
+    - targetFSpec is None if nothing must be written (--output-dir in
+      dry-run mode): only the statistics are computed.
 
     Afterwards, if this function returns True, the caller will
     - Make a backup of fspec
@@ -128,121 +654,125 @@ def fix_tabs(fspec, target_fspec, opts, data):
     # Assert what cmd_walker gives us
     if not os.path.isfile(fspec):
         ValueError("Invalid source fspec: %r" % fspec)
-    if os.path.exists(target_fspec):
-        ValueError("Target fspec must not exist: %r" % target_fspec)
-    assert os.path.abspath(fspec) != os.path.abspath(target_fspec)
+    if target_fspec is not None:
+        if os.path.exists(target_fspec):
+            ValueError("Target fspec must not exist: %r" % target_fspec)
+        assert os.path.abspath(fspec) != os.path.abspath(target_fspec)
 
     if opts.verbose >= 4:
         print("%s" % fspec)
 
-    if os.path.getsize(fspec) == 0:
+    classifier = get_classifier(opts)
+    # Content that was read by --read-ahead threads (or None)
+    prefetched = get_prefetched(fspec, data)
+    if prefetched is not None:
+        src_size = len(prefetched)
+    else:
+        src_size = os.path.getsize(fspec)
+    if src_size == 0:
         if opts.verbose >= 4:
             print("    Skipped zero-length file.")
         increment_data(data, "files_skipped")
         return False
-    elif not is_text_file(fspec):
+    is_text, reason, encoding = classifier.sniff(fspec, prefetched)
+    increment_data(data, "classified_%s" % reason)
+    if not is_text:
         if opts.verbose >= 4:
-            print("    Skipped non-text file.")
+            print("    Skipped non-text file (%s)." % reason)
         increment_data(data, "files_skipped")
         return False
     fspec = os.path.abspath(fspec)
-    inputTabSize = opts.inputTabSize or opts.tabSize
-
-    modified = False
-    lines = []
-    line_no = 0
-    changed_lines = 0
-    # Read lines as binary strings (keeping original endings)
-    stats = {DELIM_CR: 0, DELIM_LF: 0, DELIM_CRLF: 0}
-    for line in read_text_lines(fspec, stats):
-        line_no += 1
-        # Note: this strips '\r' and/or '\n'
-        org_line = line.rstrip(DELIM_CRLF)
-        # TODO: add shift-space
-        line = org_line.rstrip(b" \t")
-        s = b""
-        indent = 0
-        chars = 0
-        for c in line:
-            # Python 3 returns int, Python 2 returns str
-            if IS_PY2:
-                c = ord(c)
-            if c in (32, 160):  # Space, shift-space
-                chars += 1
-                indent += 1
-            elif c == 9:  # TAB
-                chars += 1
-                # Use integer division '//' (Py3k)
-                indent = inputTabSize * ((indent + inputTabSize) // inputTabSize)
-            else:
-                break
 
-        if opts.tabbify:
-            # Use '//' integer division (Py3k)
-            s = b"\t" * (indent // opts.tabSize) + b" " * (indent % opts.tabSize) + line[chars:]
+    kernel, res = "general", None
+    cache = data.get("result_cache")
+    cache_key = cache_entry = buf = None
+    # Large file: transform chunks in parallel (no per-line output)
+    split = (opts.splitThreshold and src_size >= opts.splitThreshold and opts.verbose < 5
+             and not encoding)
+    if not split:
+        buf = prefetched
+        if buf is None:
+            with open(fspec, "rb") as f:
+                buf = f.read()
+    if cache is not None and opts.verbose < 5:
+        if split:
+            with open(fspec, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    cache_key = cache.make_key(mm)
+                finally:
+                    mm.close()
         else:
-            s = b" " * indent + line[chars:]
-
-        lines.append(s)
-        if s != org_line:
-            modified = True
-            changed_lines += 1
-            if opts.verbose >= 5:
-                print("        #%04i: %s" % (line_no, org_line.replace(b" ", b".").replace(b"\t", b"<tab>")))
-                print("             : %s" % s.replace(b" ", b".").replace(b"\t", b"<tab>"))
-
-    # Line delimiter of input file (`None` if ambiguous)
-    ending_types = []
-#    max_ending_type = None
-#    max_ending_count = 0
-    for type_, count in stats.items():
-        if count:
-            ending_types.append(type_)
-#        if count > max_ending_count:
-#            max_ending_type = type_
-    if len(ending_types) == 1:
-        source_line_separator = ending_types[0]
-    else:
-        source_line_separator = None
-
-    if opts.lineSeparator:
-        line_separator = _SEPARATOR_MAP[opts.lineSeparator.upper()]
-    elif source_line_separator:
-        line_separator = source_line_separator
-    else:
-        line_separator = os.linesep
-        if IS_PY3:
-            line_separator = line_separator.encode("ascii")
-    assert type(line_separator) is type(b"")  # noqa E721
-
-    if source_line_separator != line_separator:
-        modified = True
-        if opts.verbose >= 4:
-            print("    Changing line separator to %s" % (_hex_string(line_separator)))
-    # Strip trailing empty lines
-    while len(lines) > 1 and lines[-1] == b"":
-        modified = True
-        lines.pop()
+            cache_key = cache.make_key(buf)
+        cache_entry = cache.get(cache_key)
+        # The output itself is only known for modified files if we compute it
+        if cache_entry is not None and (cache_entry[0] is None or opts.dry_run):
+            increment_data(data, "cache_hits")
+            output_key, output_size, line_count, changed_lines = cache_entry
+            kernel, res = None, (output_key is not None, None, line_count, changed_lines)
+            cache_key = None
+        elif cache_entry is not None:
+            # Known to need changes: the file is transformed nevertheless
+            increment_data(data, "cache_hits_dirty")
+            cache_key = None
+        else:
+            increment_data(data, "cache_misses")
+    if res is None and split:
+        kernel, res = "split", _fix_split(fspec, opts, data.get("split_pool"))
+    elif res is None:
+        if encoding:
+            # UTF-16/32: process as UTF-8 and convert back when writing
+            try:
+                buf = _decode_text(buf, encoding)
+            except UnicodeError as e:
+                if opts.verbose >= 4:
+                    print("    Skipped file with invalid %s content: %s" % (encoding, e))
+                increment_data(data, "files_skipped")
+                return False
+        if opts.planner and opts.verbose < 5:
+            kernel, res = _fix_planned(buf, opts)
+        if res is None:
+            if opts.engine == "numpy" and np is not None and opts.verbose < 5:
+                kernel, res = "numpy", _fix_numpy(buf, opts)
+            else:
+                # Split into binary lines (like read_text_lines)
+                stats = {DELIM_CR: 0, DELIM_LF: 0, DELIM_CRLF: 0}
+                res = _fix_lines(_split_lines(io.BytesIO(buf).readlines(), stats),
+                                 stats, opts)
+    modified, chunks, line_count, changed_lines = res
+    if kernel:
+        increment_data(data, "kernel_%s" % kernel)
+    if encoding and modified and chunks is not None:
+        chunks = _encode_text(chunks, encoding)
 
     if modified and opts.verbose == 3:
         print("%s" % fspec)
-    # Open with 'b', so we can have our own line endings
-    with open(target_fspec, "wb") as fout:
-        # TODO: when we optimize this ('if' before with, and remove close) , we get errors ???
-        if modified:
-            fout.write(line_separator.join(lines))
-            fout.write(line_separator)
-        fout.close()
+    if chunks is None:
+        # Cached result: nothing to write in dry-run mode
+        target_size = cache_entry[1]
+    elif target_fspec is None:
+        target_size = sum(len(chunk) for chunk in chunks) if modified else 0
+    else:
+        # Open with 'b', so we can have our own line endings
+        with open(target_fspec, "wb") as fout:
+            # TODO: when we optimize this ('if' before with, and remove close) , we get errors ???
+            if modified:
+                for chunk in chunks:
+                    fout.write(chunk)
+            fout.close()
 
-    src_size = os.path.getsize(fspec)
-    target_size = os.path.getsize(target_fspec)
+        target_size = os.path.getsize(target_fspec)
+    if cache_key is not None:
+        # (The output of split files is not recorded: their content is not in memory)
+        _cache_result(cache, cache_key, buf, (modified, chunks, line_count, changed_lines),
+                      target_size, opts, record_output=not encoding and not split)
     increment_data(data, "bytes_read", src_size)
     increment_data(data, "bytes_written", target_size)
     if modified:
         increment_data(data, "bytes_written_if", target_size)
     else:
         increment_data(data, "bytes_written_if", src_size)
-    increment_data(data, "lines_processed", len(lines))
+    increment_data(data, "lines_processed", line_count)
     increment_data(data, "lines_modified", changed_lines)
 
     if modified and opts.verbose >= 4:
@@ -253,7 +783,186 @@ def fix_tabs(fspec, target_fspec, opts, data):
     return modified
 
 
-def run():
+def _cache_result(cache, key, buf, res, target_size, opts, record_output=True):
+    """Store the result of fix_tabs in the --cache."""
+    modified, chunks, line_count, changed_lines = res
+    if not modified:
+        cache.put(key, None, 0, line_count, changed_lines)
+        return
+    output_key = cache.make_key(*chunks)
+    cache.put(key, output_key, target_size, line_count, changed_lines)
+    # The fixed output is clean, so we can also record it (saves a miss after
+    # the fixed files were committed). This does not hold if tabs are
+    # re-interpreted (--input-tab-size) or for some non-breaking space patterns.
+    if record_output and opts.inputTabSize in (None, opts.tabSize) and b"\xa0" not in buf:
+        output_lines = sum(chunk.count(DELIM_LF) for chunk in chunks)
+        if not output_lines:
+            output_lines = sum(chunk.count(DELIM_CR) for chunk in chunks)
+        cache.put(output_key, None, 0, output_lines, 0)
+    return
+
+
+# ===============================================================================
+# scan_file
+# ==============================================================================
+
+# Line ending names used in --scan reports
+_SEPARATOR_NAMES = {DELIM_CR: "CR", DELIM_LF: "LF", DELIM_CRLF: "CRLF"}
+
+# Counters that are reported per file and summed up per folder by --scan
+SCAN_COUNTERS = (
+    "size", "output_size",
+    "lines", "lines_modified",
+    "tab_indented", "space_indented", "mixed_indented",
+    "trailing_whitespace", "trailing_blank_lines",
+    )
+
+
+def _count_whitespace(lines, counts):
+    """Pass through an iterator of binary lines, counting indentation types."""
+    for line in lines:
+        org_line = line.rstrip(DELIM_CRLF)
+        text = org_line.rstrip(b" \t")
+        if len(text) != len(org_line):
+            counts["trailing_whitespace"] += 1
+        indent = text[:len(text) - len(text.lstrip(b" \t"))]
+        if indent:
+            if b"\t" not in indent:
+                counts["space_indented"] += 1
+            elif b" " not in indent:
+                counts["tab_indented"] += 1
+            else:
+                counts["mixed_indented"] += 1
+        counts["lines"] += 1
+        yield line
+    return
+
+
+def _write_scan_record(data, record):
+    data["scan_stream"].write(json.dumps(record, sort_keys=True))
+    data["scan_stream"].write("\n")
+
+
+def scan_file(fspec, target_fspec, opts, data):
+    """Report the whitespace inventory of a file, without modifying anything (--scan).
+
+    One JSON record per file is written to data["scan_stream"] and counters are
+    summed up per folder in data["scan_folders"]. A folder record is written
+    as soon as the walker has left the folder (see write_scan_summary()).
+    Always returns False, so cmd_walker never touches the file (with
+    opts.read_only set, `target_fspec` is None).
+    """
+    fspec = os.path.abspath(fspec)
+    write_scan_summary(data, os.path.dirname(fspec))
+    classifier = get_classifier(opts)
+    encoding = None
+    # (Files with a binary extension are rejected by cmd_walker)
+    src_size = os.path.getsize(fspec)
+    record = {"type": "file", "path": fspec, "size": src_size}
+    if src_size == 0:
+        record["skipped"] = "empty"
+    else:
+        is_text, reason, encoding = classifier.sniff(fspec)
+        increment_data(data, "classified_%s" % reason)
+        if not is_text:
+            record["skipped"] = "binary"
+    if encoding:
+        record["encoding"] = encoding
+        with open(fspec, "rb") as f:
+            try:
+                raw_lines = io.BytesIO(_decode_text(f.read(), encoding)).readlines()
+            except UnicodeError:
+                record["skipped"] = "binary"
+    if record.get("skipped"):
+        increment_data(data, "files_skipped")
+        _write_scan_record(data, record)
+        return False
+
+    counts = dict((key, 0) for key in SCAN_COUNTERS)
+    stats = {DELIM_CR: 0, DELIM_LF: 0, DELIM_CRLF: 0}
+    if encoding:
+        lines = _split_lines(raw_lines, stats)
+    else:
+        lines = read_text_lines(fspec, stats)
+    modified, chunks, line_count, changed_lines = _fix_lines(
+        _count_whitespace(lines, counts), stats, opts)
+    if encoding and modified:
+        chunks = _encode_text(chunks, encoding)
+
+    counts["size"] = src_size
+    counts["output_size"] = sum(len(chunk) for chunk in chunks) if modified else src_size
+    counts["lines_modified"] = changed_lines
+    counts["trailing_blank_lines"] = counts["lines"] - line_count
+    record.update(counts)
+    record["modified"] = modified
+    record["line_endings"] = dict((_SEPARATOR_NAMES[type_], count)
+                                  for type_, count in stats.items())
+    _write_scan_record(data, record)
+
+    increment_data(data, "bytes_read", src_size)
+    increment_data(data, "bytes_written_if", counts["output_size"])
+    increment_data(data, "lines_processed", line_count)
+    increment_data(data, "lines_modified", changed_lines)
+    if modified:
+        increment_data(data, "files_modified_if")
+        if opts.verbose >= 3:
+            print("%s" % fspec)
+
+    # Sum up per folder (this is much less than one entry per file)
+    folder = data.setdefault("scan_folders", {}).get(os.path.dirname(fspec))
+    if folder is None:
+        folder = dict((key, 0) for key in SCAN_COUNTERS)
+        folder["files"] = folder["files_modified"] = 0
+        data["scan_folders"][os.path.dirname(fspec)] = folder
+    for key in SCAN_COUNTERS:
+        folder[key] += counts[key]
+    folder["files"] += 1
+    if modified:
+        folder["files_modified"] += 1
+    return False
+
+
+def write_scan_summary(data, current_folder=None):
+    """Write the per-folder records collected by scan_file().
+
+    If `current_folder` is passed, only folders that the walker has left are
+    written and removed: it never returns to a folder once it has processed a
+    file outside the folder's subtree (sub folders are walked depth first).
+    """
+    folders = data.get("scan_folders", {})
+    for path in sorted(folders):
+        if current_folder is not None and (
+                current_folder == path or current_folder.startswith(os.path.join(path, ""))):
+            continue
+        record = {"type": "folder", "path": path}
+        record.update(folders.pop(path))
+        _write_scan_record(data, record)
+    return
+
+
+def _run_process(args, opts, func, data):
+    """Call process(), or profile_process() if --profile was passed.
+
+    With --split-threshold, one pool of split workers is shared by all files
+    of the run.
+    """
+    if opts.splitThreshold and not opts.read_only:
+        data["split_pool"] = create_split_pool(opts)
+    try:
+        if opts.profile_path:
+            profile_process(args, opts, func, data, opts.profile_path,
+                            trace_memory=opts.profile_memory)
+        else:
+            process(args, opts, func, data)
+    finally:
+        pool = data.pop("split_pool", None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def run(argv=None):
+    """Run the command line tool (`argv` defaults to sys.argv[1:])."""
     # Create option parser for common and custom options
     parser = OptionParser(usage="usage: %prog [options] [PATH]",
                           prog="tabfix",  # Otherwise 'tabfix-script.py' gets displayed
@@ -278,26 +987,98 @@ def run():
                       help="line separator used for output file. "
                       "Possible values: Unix, Windows, Mac, LF, CRLF, CR "
                       "(default: keep mode from input file)")
+    parser.add_option("", "--engine",
+                      action="store", dest="engine", type="choice", choices=ENGINES,
+                      default="python", metavar="NAME",
+                      help="implementation used to transform files: "
+                      "python or numpy (requires NumPy, default: %default)")
+    parser.add_option("", "--no-planner",
+                      action="store_false", dest="planner", default=True,
+                      help="always use the general transformation, even if a "
+                      "specialized kernel would suffice (e.g. to only convert line endings)")
+    parser.add_option("", "--split-threshold",
+                      action="store", dest="splitThreshold", type="float", default=None,
+                      metavar="MB",
+                      help="transform files larger than MB megabytes in parallel chunks "
+                      "(default: off)")
+    parser.add_option("", "--split-workers",
+                      action="store", dest="splitWorkers", type="int", default=None,
+                      metavar="N",
+                      help="number of worker processes used by --split-threshold "
+                      "(default: number of CPUs)")
+    parser.add_option("", "--cache",
+                      action="store", dest="cache_path", default=None,
+                      metavar="FILENAME",
+                      help="remember results by file content in FILENAME and skip "
+                      "files with known clean content; files that are known to "
+                      "need changes are still transformed (may be shared between "
+                      "checkouts)")
+    parser.add_option("", "--scan",
+                      action="store", dest="scan_path", default=None,
+                      metavar="FILENAME",
+                      help="don't change anything, but write a whitespace report "
+                      "for every file and folder to FILENAME (JSON Lines)")
+    parser.add_option("", "--profile",
+                      action="store", dest="profile_path", default=None,
+                      metavar="DIR",
+                      help="run with cProfile and write the statistics and a summary "
+                      "of the slowest functions and files to DIR")
+    parser.add_option("", "--profile-memory",
+                      action="store_true", dest="profile_memory", default=False,
+                      help="also record the peak memory per file with tracemalloc "
+                      "(requires --profile and Python 3.9+)")
 
     add_common_options(parser)
 
     # Parse command line
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
 
     # Check syntax
     check_common_options(parser, options, args)
 
     if options.lineSeparator and options.lineSeparator.upper() not in list(_SEPARATOR_MAP.keys()):
         parser.error("--line-separator must be one of '%s'" % "', '".join(list(_SEPARATOR_MAP.keys())))
+    if options.engine == "numpy" and np is None:
+        parser.error("--engine=numpy requires NumPy to be installed")
+    if options.splitThreshold:
+        options.splitThreshold = int(options.splitThreshold * 1024 * 1024)
+    if options.profile_memory and not options.profile_path:
+        parser.error("--profile-memory requires --profile")
+    elif options.profile_memory and not can_trace_memory():
+        parser.error("--profile-memory requires Python 3.9 or later")
+    if options.scan_path and (options.target_path or options.backup or options.output_path):
+        parser.error("--scan cannot be combined with -o, -b, --zip-backup, or --output-dir")
 
     # Call processor
     data = {}
-    process(args, options, fix_tabs, data)
+    if options.scan_path:
+        # Read-only: never create temp files or backups
+        options.dry_run = True
+        options.read_only = True
+        data["files_modified_if"] = 0
+        with open(options.scan_path, "w") as f:
+            data["scan_stream"] = f
+            _run_process(args, options, scan_file, data)
+            write_scan_summary(data)
+        data["files_modified"] = data["files_modified_if"]
+    elif options.cache_path:
+        data["result_cache"] = ResultCache(options.cache_path, options)
+        try:
+            _run_process(args, options, fix_tabs, data)
+        finally:
+            data["result_cache"].save()
+    else:
+        _run_process(args, options, fix_tabs, data)
 
     # Print summary
-    if options.verbose >= 3 and data.get("zipfile"):
+    if options.verbose >= 3 and data.get("zipfile_parts"):
+        print()
+        print(("Backup archive:\n    %s" % "\n    ".join(data["zipfile_parts"])))
+    if options.verbose >= 3 and options.output_path:
         print()
-        print(("Backup archive:\n    %s" % data.get("zipfile_fspec")))
+        print("Output folder:\n    %s (copied %d, linked %d unmodified files)"
+              % (os.path.abspath(options.output_path),
+                 data["files_copied"], data["files_linked"]))
 
     if options.verbose >= 2:
         print()
@@ -317,6 +1098,18 @@ def run():
                  rate, data["elapsed_string"]))
 #        print(data)
 
+    if data.get("result_cache") and options.verbose >= 2:
+        print("\nResult cache: %d hits, %d hits that need changes, %d misses\n    %s"
+              % (data.get("cache_hits", 0), data.get("cache_hits_dirty", 0),
+                 data.get("cache_misses", 0), os.path.abspath(options.cache_path)))
+    if options.read_ahead and options.verbose >= 2:
+        print("\nRead-ahead: %d files (%d bytes), %d files announced to the OS"
+              % (data["files_read_ahead"], data["bytes_read_ahead"],
+                 data["files_advised"]))
+    if data.get("profile_files") and options.verbose >= 2:
+        print("\nProfile:\n    %s" % "\n    ".join(data["profile_files"]))
+    if options.scan_path and options.verbose >= 2:
+        print("\nScan report:\n    %s" % os.path.abspath(options.scan_path))
     if options.dry_run and options.verbose >= 2:
         print("\n*** Dry-run mode: no files have been modified! ***\n")
 
@@ -0,0 +1,125 @@
+# (c) 2010, 2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Profile a cmd_walker.process() run (--profile DIR).
+
+Writes two files to DIR:
+    tabfix-<timestamp>.pstats  cProfile data (open with `python -m pstats`)
+    tabfix-<timestamp>.txt     top functions, and the slowest files (and the
+                               files with the highest peak memory, if
+                               --profile-memory was passed)
+
+Note: worker processes (--split-workers) are not profiled.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import cProfile
+from datetime import datetime
+import heapq
+import os
+import pstats
+import sys
+
+from tabfix.cmd_walker import _timer, process
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+PROFILE_TOP_COUNT = 30
+
+
+def _unique_fspec(folder, name, ext):
+    fspec = os.path.join(folder, name + ext)
+    i = 1
+    while os.path.exists(fspec):
+        i += 1
+        fspec = os.path.join(folder, "%s_%d%s" % (name, i, ext))
+    return fspec
+
+
+def _wrap_processor(func, records, trace_memory):
+    """Return a processor that appends (elapsed, peak_bytes, fspec) to records."""
+    def _profiled_func(fspec, target_fspec, opts, data):
+        if trace_memory:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = _timer()
+        try:
+            return func(fspec, target_fspec, opts, data)
+        finally:
+            elapsed = _timer() - start
+            peak = 0
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+            records.append((elapsed, peak, fspec))
+    return _profiled_func
+
+
+def can_trace_memory():
+    """Return True if per-file peak memory can be recorded (Python 3.9+)."""
+    return tracemalloc is not None and hasattr(tracemalloc, "reset_peak")
+
+
+def profile_process(args, opts, func, data, folder, trace_memory=False):
+    """Call process() with cProfile enabled and write the reports to <folder>.
+
+    Return the paths of the .pstats and .txt file.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    name = "tabfix-{}".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+    stats_fspec = _unique_fspec(folder, name, ".pstats")
+    summary_fspec = stats_fspec[:-len(".pstats")] + ".txt"
+
+    records = []
+    trace_memory = trace_memory and can_trace_memory()
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(process, args, opts,
+                         _wrap_processor(func, records, trace_memory), data)
+    finally:
+        total_peak = 0
+        if trace_memory:
+            total_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        profiler.dump_stats(stats_fspec)
+        # Escape file names that are not valid in the file system encoding
+        kwargs = {"errors": "backslashreplace"} if sys.version_info[0] >= 3 else {}
+        with open(summary_fspec, "w", **kwargs) as f:
+            _write_summary(f, profiler, records, total_peak, data)
+
+    data["profile_files"] = (stats_fspec, summary_fspec)
+    return stats_fspec, summary_fspec
+
+
+def _write_summary(f, profiler, records, total_peak, data, top=PROFILE_TOP_COUNT):
+    f.write("tabfix profile, %s\n" % datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    f.write("Command line: %s\n" % " ".join(sys.argv))
+    f.write("Files processed: %d, modified: %d, bytes read: %d\n"
+            % (data.get("files_processed", 0), data.get("files_modified", 0),
+               data.get("bytes_read", 0)))
+    f.write("Time in processor: %.3f sec\n" % sum(r[0] for r in records))
+    if total_peak:
+        f.write("Peak memory (tracemalloc): %.2f MB\n" % (total_peak / (1024.0 * 1024)))
+
+    f.write("\nTop %d files by time:\n" % top)
+    for elapsed, _peak, fspec in heapq.nlargest(top, records):
+        f.write("    %8.4f sec  %s\n" % (elapsed, fspec))
+    if total_peak:
+        f.write("\nTop %d files by peak memory:\n" % top)
+        for peak, elapsed, fspec in heapq.nlargest(top, [(r[1], r[0], r[2]) for r in records]):
+            f.write("    %8.1f kB  %s\n" % (peak / 1024.0, fspec))
+
+    stats = pstats.Stats(profiler, stream=f)
+    stats.strip_dirs()
+    f.write("\nTop %d functions by cumulative time:\n" % top)
+    stats.sort_stats("cumulative").print_stats(top)
+    f.write("\nTop %d functions by internal time:\n" % top)
+    stats.sort_stats("tottime").print_stats(top)
+    return
@@ -0,0 +1,144 @@
+# (c) 2010, 2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Live progress display for cmd_walker.process() (--progress).
+
+The walker only updates its counters in the `data` dict. A timer thread reads
+them a few times per second and rewrites a single status line on stderr, so
+the processing loop itself never prints or formats anything.
+A second thread counts the files that will be visited, so an ETA can be shown.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import threading
+
+from tabfix.cmd_walker import _timer, is_matching
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+# ==============================================================================
+# ProgressReporter
+# ==============================================================================
+class ProgressReporter(object):
+    """Display files/s, MB/s, ETA, and current counts while a walk is running.
+
+    Usage:
+        reporter = ProgressReporter(args, opts, data)
+        reporter.start()
+        try:
+            process(...)
+        finally:
+            reporter.stop()
+    """
+    def __init__(self, args, opts, data, stream=None, interval=0.5):
+        self.args = args
+        self.opts = opts
+        self.data = data
+        self.stream = stream or sys.stderr
+        self.is_tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        # Don't flood log files
+        self.interval = interval if self.is_tty else max(interval, 10.0)
+        self.total_files = 0
+        self.count_complete = False
+        self.start_time = None
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._last_len = 0
+
+    def _is_matching_file(self, name):
+        return (is_matching(name, self.opts.match_list)
+                and not is_matching(name, self.opts.ignore_list))
+
+    def count_files(self):
+        """Count the files that the walker will pass to the processor.
+
+        This is an estimate: ignore files (--use-ignore-files) are not evaluated
+        and symlinked folders are not followed.
+        """
+        opts = self.opts
+        self.count_complete = False
+        if not opts.match_list:
+            self.total_files = len(self.args)
+            self.count_complete = True
+            return self.total_files
+        self.total_files = 0
+        for path in self.args:
+            for _root, dirs, files in os.walk(path):
+                if self._stop_event.is_set():
+                    return self.total_files
+                self.total_files += sum(1 for name in files if self._is_matching_file(name))
+                if opts.recursive:
+                    dirs[:] = [name for name in dirs if not is_matching(name, opts.ignore_list)]
+                else:
+                    del dirs[:]
+        self.count_complete = True
+        return self.total_files
+
+    def format_status(self):
+        """Return the current status line."""
+        data = self.data
+        elapsed = max(_timer() - self.start_time, 1e-6)
+        done = (data.get("files_processed", 0) + data.get("files_resumed", 0)
+                + data.get("files_deduplicated", 0))
+        files_per_sec = done / elapsed
+        mb_per_sec = data.get("bytes_read", 0) / elapsed / (1024 * 1024)
+
+        if self.count_complete:
+            total = max(self.total_files, done)
+            res = "%d/%d files" % (done, total)
+            if total:
+                res += " (%d%%)" % (100 * done // total)
+        else:
+            res = "%d/%d+ files" % (done, max(self.total_files, done))
+        res += ", %.1f files/s, %.2f MB/s, modified: %d" % (
+            files_per_sec, mb_per_sec, data.get("files_modified", 0))
+        if data.get("exceptions"):
+            res += ", errors: %d" % data["exceptions"]
+        if self.count_complete and files_per_sec > 0:
+            eta = (max(self.total_files, done) - done) / files_per_sec
+            res += ", ETA %s" % _format_duration(eta)
+        else:
+            res += ", elapsed %s" % _format_duration(elapsed)
+        return res
+
+    def _write_status(self, final=False):
+        line = self.format_status()
+        if self.is_tty:
+            # Overwrite the previous line (and erase its remains)
+            pad = max(0, self._last_len - len(line))
+            self.stream.write("\r%s%s" % (line, " " * pad))
+            self._last_len = len(line)
+            if final:
+                self.stream.write("\n")
+        else:
+            self.stream.write("%s\n" % line)
+        self.stream.flush()
+
+    def _run_timer(self):
+        while not self._stop_event.wait(self.interval):
+            self._write_status()
+
+    def start(self):
+        self.start_time = _timer()
+        for target in (self.count_files, self._run_timer):
+            t = threading.Thread(target=target, name="tabfix-progress")
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        """Stop the threads and print the final status."""
+        self._stop_event.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._write_status(final=True)
+        return
@@ -0,0 +1,135 @@
+# (c) 2010, 2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Content-hash cache of fix_tabs results (--cache FILENAME).
+
+Entries are keyed by a hash of the file content and of the options that affect
+the output, so a cache file stays valid across checkouts and machines (e.g. as
+a CI artifact), independent of paths and modification times.
+
+Every entry records whether the content is already clean, or the key of the
+fixed output (plus its size and line counts, so statistics stay exact).
+Only the key of the output is stored, not the output itself: files that are
+known to need changes are still transformed (except in dry-run mode), and
+counted as `cache_hits_dirty`.
+
+File format: a 16 byte header (magic and hash algorithm), followed by
+fixed-size binary records. New entries are appended by `save()`.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import os
+import struct
+
+from tabfix._version import __version__
+
+
+CACHE_MAGIC = b"TABFIXC1"
+
+# key, key of the fixed output (zeros: already clean), output size,
+# line count, changed lines
+_RECORD = struct.Struct("<16s16sQII")
+
+_CLEAN = b"\0" * 16
+
+if hasattr(hashlib, "blake2b"):
+    _HASH_NAME = "blake2b"
+
+    def _new_hash():
+        return hashlib.blake2b(digest_size=16)
+else:  # Python 2
+    _HASH_NAME = "sha1"
+
+    def _new_hash():
+        return hashlib.sha1()
+
+
+def options_fingerprint(opts):
+    """Return a bytes string that identifies all options that affect the output."""
+    return ("%s|%s|%r|%r|%r|%r" % (
+        __version__, _HASH_NAME, opts.tabSize, opts.inputTabSize,
+        bool(opts.tabbify), opts.lineSeparator and opts.lineSeparator.upper())
+    ).encode("ascii")
+
+
+# ==============================================================================
+# ResultCache
+# ==============================================================================
+class ResultCache(object):
+    """Map content hashes to fix_tabs results, persisted in a binary file.
+
+    Entries are (output_key, output_size, line_count, changed_lines) tuples,
+    where output_key is None if the content is already clean.
+    """
+    def __init__(self, fspec, opts):
+        self.fspec = fspec
+        self.entries = {}
+        self.new_entries = {}
+        self._valid_file = False
+        self._hasher = _new_hash()
+        self._hasher.update(options_fingerprint(opts))
+        self._header = CACHE_MAGIC + _HASH_NAME.encode("ascii").ljust(8, b"\0")
+        self.load()
+
+    def make_key(self, *chunks):
+        """Return the key for content (and the current options)."""
+        h = self._hasher.copy()
+        for chunk in chunks:
+            h.update(chunk)
+        return h.digest()[:16]
+
+    def load(self):
+        self.entries = {}
+        self._valid_file = False
+        if not os.path.exists(self.fspec):
+            return
+        with open(self.fspec, "rb") as f:
+            buf = f.read()
+        if not buf.startswith(self._header):
+            # Other format or hash algorithm: start from scratch
+            return
+        self._valid_file = True
+        size = _RECORD.size
+        # Ignore an incomplete last record (e.g. interrupted while saving)
+        end = len(self._header) + (len(buf) - len(self._header)) // size * size
+        for ofs in range(len(self._header), end, size):
+            key, output_key, output_size, line_count, changed_lines = \
+                _RECORD.unpack_from(buf, ofs)
+            if output_key == _CLEAN:
+                output_key = None
+            self.entries[key] = (output_key, output_size, line_count, changed_lines)
+        return
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, output_key, output_size, line_count, changed_lines):
+        entry = (output_key, output_size, line_count, changed_lines)
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.new_entries[key] = entry
+        return
+
+    def save(self):
+        """Append new entries to the cache file (rewrite it, if it was invalid)."""
+        if not self.new_entries and self._valid_file:
+            return
+        if self._valid_file:
+            # Start at a record boundary (discard an incomplete last record)
+            size = os.path.getsize(self.fspec)
+            f = open(self.fspec, "r+b")
+            f.truncate(size - (size - len(self._header)) % _RECORD.size)
+            f.seek(0, os.SEEK_END)
+        else:
+            f = open(self.fspec, "wb")
+            f.write(self._header)
+        with f:
+            for key, (output_key, output_size, line_count, changed_lines) \
+                    in self.new_entries.items():
+                f.write(_RECORD.pack(key, output_key or _CLEAN, output_size,
+                                     line_count, changed_lines))
+        self.new_entries = {}
+        self._valid_file = True
+        return
@@ -0,0 +1,62 @@
+# -*- coding: iso-8859-1 -*-
+# (c) 2010-2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmark the --durability modes on many small modified files.
+
+Usage:
+    python -m tests.bench_durability [FILE_COUNT]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tabfix import cmd_walker, main
+
+
+def _create_files(path, count):
+    os.mkdir(path)
+    content = b"\tdef foo(self):  \r\n\t\tif x:\r\n\t\t\treturn 42\t\r\n" * 20
+    for i in range(count):
+        # Spread the files over a few folders
+        folder = os.path.join(path, "sub%02d" % (i % 10))
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        with open(os.path.join(folder, "file%05d.py" % i), "wb") as f:
+            f.write(content)
+
+
+def _run(path, durability):
+    opts = main.Opts()
+    opts.backup = False
+    opts.durability = durability
+    opts.match_list = ["*.py"]
+    opts.recursive = True
+    opts.verbose = 0
+    data = {}
+    start = time.time()
+    cmd_walker.process([path], opts, main.fix_tabs, data)
+    return time.time() - start, data
+
+
+def bench(count=2000):
+    temp_path = tempfile.mkdtemp()
+    try:
+        print("Files: %d (in %s)" % (count, temp_path))
+        for durability in cmd_walker.DURABILITY_MODES:
+            path = os.path.join(temp_path, durability)
+            _create_files(path, count)
+            elapsed, data = _run(path, durability)
+            print("    %-6s %7.2f sec, %5d fsync calls, %7.1f files/sec"
+                  % (durability, elapsed, data["fsync_calls"],
+                     data["files_modified"] / elapsed))
+    finally:
+        shutil.rmtree(temp_path)
+
+
+if __name__ == "__main__":
+    bench(*[int(arg) for arg in sys.argv[1:]])
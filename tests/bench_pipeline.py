@@ -0,0 +1,95 @@
+# -*- coding: iso-8859-1 -*-
+# (c) 2010-2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmark --read-ahead and --write-behind (with --durability file).
+
+Before every run the files are evicted from the page cache (if the OS
+supports `posix_fadvise(DONTNEED)`), so reads hit the disk.
+
+Usage:
+    python -m tests.bench_pipeline [FILE_COUNT [FILE_KB]]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tabfix import cmd_walker, main
+
+
+CONFIGS = (
+    # read_ahead, write_behind
+    (0, 0),
+    (8, 0),
+    (0, 4),
+    (8, 4),
+    )
+
+
+def _create_files(path, count, size_kb):
+    os.mkdir(path)
+    # Only trailing whitespace: transformed by a fast kernel, so I/O dominates
+    line = b"    def foo(self):  \n        if x:\n            return 42\t\n"
+    content = line * (size_kb * 1024 // len(line) + 1)
+    for i in range(count):
+        folder = os.path.join(path, "sub%02d" % (i % 10))
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        with open(os.path.join(folder, "file%05d.py" % i), "wb") as f:
+            f.write(content)
+
+
+def _evict(path):
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for folder, _dirs, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(folder, name), os.O_RDONLY)
+            try:
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def _run(path, read_ahead, write_behind):
+    opts = main.Opts()
+    opts.backup = False
+    opts.durability = "file"
+    opts.match_list = ["*.py"]
+    opts.recursive = True
+    opts.verbose = 0
+    opts.read_ahead = read_ahead
+    opts.write_behind = write_behind
+    data = {}
+    start = time.time()
+    cmd_walker.process([path], opts, main.fix_tabs, data)
+    return time.time() - start, data
+
+
+def bench(count=500, size_kb=64):
+    temp_path = tempfile.mkdtemp()
+    try:
+        print("Files: %d x %d kB (in %s)" % (count, size_kb, temp_path))
+        base = None
+        for read_ahead, write_behind in CONFIGS:
+            path = os.path.join(temp_path, "r%d_w%d" % (read_ahead, write_behind))
+            _create_files(path, count, size_kb)
+            cold = _evict(path)
+            elapsed, data = _run(path, read_ahead, write_behind)
+            base = base or elapsed
+            print("    read-ahead %d, write-behind %d: %7.2f sec (speedup %.2fx), "
+                  "%d files read ahead%s"
+                  % (read_ahead, write_behind, elapsed, base / elapsed,
+                     data["files_read_ahead"], "" if cold else " (warm cache)"))
+    finally:
+        shutil.rmtree(temp_path)
+
+
+if __name__ == "__main__":
+    bench(*[int(arg) for arg in sys.argv[1:]])
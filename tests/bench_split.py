@@ -0,0 +1,65 @@
+# -*- coding: iso-8859-1 -*-
+# (c) 2010-2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmark intra-file parallelism (--split-threshold) on a single huge file.
+
+Usage:
+    python -m tests.bench_split [SIZE_MB]
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tabfix import main
+
+
+def _create_file(fspec, size):
+    block = (b"\tdef foo(self):  \r\n"
+             b"\t\tif x:\r\n"
+             b"    \t    return 42\t\r\n"
+             b"\r\n") * 1024
+    with open(fspec, "wb") as f:
+        for _ in range(max(1, size // len(block))):
+            f.write(block)
+
+
+def _run(fspec, split_threshold, workers):
+    opts = main.Opts()
+    opts.verbose = 0
+    opts.splitThreshold = split_threshold
+    opts.splitWorkers = workers
+    target = fspec + ".out"
+    data = {}
+    start = time.time()
+    main.fix_tabs(fspec, target, opts, data)
+    elapsed = time.time() - start
+    os.remove(target)
+    return elapsed
+
+
+def bench(size_mb=64):
+    temp_path = tempfile.mkdtemp()
+    try:
+        fspec = os.path.join(temp_path, "huge.txt")
+        _create_file(fspec, size_mb * 1024 * 1024)
+        print("File size: %d MB, CPUs: %d" % (size_mb, multiprocessing.cpu_count()))
+
+        base = _run(fspec, None, None)
+        print("    serial:     %7.2f sec" % base)
+        workers = 1
+        while workers <= multiprocessing.cpu_count():
+            elapsed = _run(fspec, 1, workers)
+            print("    %2d workers: %7.2f sec (speedup %.2fx)" % (workers, elapsed, base / elapsed))
+            workers *= 2
+    finally:
+        shutil.rmtree(temp_path)
+
+
+if __name__ == "__main__":
+    bench(*[int(arg) for arg in sys.argv[1:]])
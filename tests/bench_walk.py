@@ -0,0 +1,70 @@
+# -*- coding: iso-8859-1 -*-
+# (c) 2010-2013 Martin Wendt; see https://github.com/mar10/tabfix
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmark threaded folder listing (--walk-threads) on a simulated network
+file system: every folder listing is delayed by LATENCY_MS milliseconds.
+
+Usage:
+    python -m tests.bench_walk [LATENCY_MS [FANOUT [DEPTH]]]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tabfix import cmd_walker, main
+
+
+def _create_tree(path, fanout, depth):
+    os.mkdir(path)
+    for i in range(4):
+        with open(os.path.join(path, "file%d.py" % i), "wb") as f:
+            f.write(b"\tdef foo(self):  \r\n\t\treturn 42\r\n")
+    if depth > 0:
+        for i in range(fanout):
+            _create_tree(os.path.join(path, "sub%d" % i), fanout, depth - 1)
+
+
+def _run(path, latency, threads, ordered):
+    def _list_folder(folder):
+        time.sleep(latency)  # Releases the GIL, like waiting for a server
+        return cmd_walker.list_folder(folder)
+
+    opts = main.Opts()
+    opts.dry_run = True
+    opts.match_list = ["*.py"]
+    opts.recursive = True
+    opts.verbose = 0
+    opts.walk_threads = threads
+    opts.walk_ordered = ordered
+    data = {}
+    start = time.time()
+    cmd_walker.process([path], opts, main.fix_tabs, data, list_func=_list_folder)
+    return time.time() - start, data
+
+
+def bench(latency_ms=5, fanout=6, depth=3):
+    temp_path = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_path, "tree")
+        _create_tree(path, fanout, depth)
+        base, data = _run(path, latency_ms / 1000.0, 0, True)
+        print("Folders: %d, files: %d, listing latency: %d ms"
+              % (data["dirs_processed"], data["files_processed"], latency_ms))
+        print("    serial:                 %7.2f sec" % base)
+        for threads in (2, 4, 8, 16, 32):
+            for ordered in (True, False):
+                elapsed, _data = _run(path, latency_ms / 1000.0, threads, ordered)
+                print("    %2d threads, %-11s %7.2f sec (speedup %.2fx)"
+                      % (threads, "ordered:" if ordered else "unordered:",
+                         elapsed, base / elapsed))
+    finally:
+        shutil.rmtree(temp_path)
+
+
+if __name__ == "__main__":
+    bench(*[int(arg) for arg in sys.argv[1:]])
@@ -5,13 +5,20 @@
 Unit tests for this package.
 """
 import tempfile
+import codecs
+import errno
 import filecmp
+import io
+import json
 from zipfile import ZipFile
 import unittest
 import os
+import pstats
+import random
 import shutil
 import sys
-from tabfix import main, cmd_walker
+from tabfix import main, cmd_walker, profiling, result_cache
+from tabfix.progress import ProgressReporter
 from tabfix.main import read_text_lines, DELIM_CR, DELIM_CRLF, DELIM_LF
 #import subprocess
 #import StringIO
@@ -20,8 +27,23 @@ from tabfix.main import read_text_lines, DELIM_CR, DELIM_CRLF, DELIM_LF
 USE_FIXED_FOLDER = False
 
 
-class TestBasic(unittest.TestCase):
-    """Basic tests.
+def fix_file_copy(fspec, opts):
+    """Run fix_tabs on a copy of fspec and return (output, data)."""
+    src = fspec + ".src"
+    target = fspec + ".out"
+    shutil.copyfile(fspec, src)
+    data = {}
+    if not main.fix_tabs(src, target, opts, data):
+        shutil.copyfile(src, target)
+    with open(target, "rb") as f:
+        res = f.read()
+    os.remove(src)
+    os.remove(target)
+    return res, data
+
+
+class TestFilesCase(unittest.TestCase):
+    """Base class for tests that use the test files.
 
     Create a temp folder, extract test data there, and CWD to <temp>/test_files:
 
@@ -52,6 +74,10 @@ class TestBasic(unittest.TestCase):
         os.chdir(self.prev_cwd)
         shutil.rmtree(self.temp_path)
 
+
+class TestBasic(TestFilesCase):
+    """Basic tests."""
+
     def test_read_text_lines(self):
 
         stats = { DELIM_CR: 0, DELIM_LF: 0, DELIM_CRLF: 0 }
@@ -193,6 +219,868 @@ class TestBasic(unittest.TestCase):
         self.assertEqual(data.get("dirs_processed"), 2)
         self.assertEqual(data.get("dirs_ignored"), 1)
 
+    def test_match_all_recursive_ignore_files(self):
+        with open(".gitignore", "w") as f:
+            f.write("# Same as test_match_all_recursive_ignore\n*.html\n/sub2/\n.*ignore\n")
+        with open(".tabfixignore", "w") as f:
+            f.write("*.js\n")
+        with open(os.path.join("sub1", ".tabfixignore"), "w") as f:
+            f.write("!test_mixed.html\n")
+
+        args = ["."]
+        opts = main.Opts()
+        opts.match_list = ["*.*"]
+        opts.recursive = True
+        opts.use_ignore_files = True
+
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+
+        # sub1/test_mixed.html was re-included
+        self.assertEqual(data.get("files_processed"), 15)
+        self.assertEqual(data.get("files_ignored"), 6)
+        self.assertEqual(data.get("dirs_processed"), 2)
+        self.assertEqual(data.get("dirs_ignored"), 1)
+
+    def test_durability(self):
+        # sub1 and sub2 contain the same files
+        results = []
+        for path, durability in (("sub1", "file"), ("sub2", "batch")):
+            opts = main.Opts()
+            opts.backup = True
+            opts.durability = durability
+            opts.durability_batch = 2
+            opts.match_list = ["*.*"]
+            opts.verbose = 1
+
+            data = {}
+            cmd_walker.process([path], opts, main.fix_tabs, data)
+            self.assertEqual(data.get("files_modified"), 3)
+            self.assertEqual(data.get("pending_commits"), [])
+            self.assertTrue(data.get("fsync_calls") > 0)
+            if durability == "batch":
+                # Every temp file, and the folder once per group (of 2 files)
+                self.assertEqual(data.get("fsync_calls"), 3 + 2)
+            self.assertTrue(os.path.isfile(os.path.join(path, "test_mixed.js.bak")))
+            with open(os.path.join(path, "test_mixed.js"), "rb") as f:
+                results.append(f.read())
+        self.assertEqual(results[0], results[1])
+
+    def test_durability_cli(self):
+        with open("sub1/test_mixed.js", "rb") as f:
+            content = f.read()
+        main.run(["-q", "-b", "-m", "*.*", "--durability", "batch", "--durability-batch", "2",
+                  "sub2"])
+        self.assertTrue(os.path.isfile(os.path.join("sub2", "test_mixed.js.bak")))
+        self.assertFalse([name for name in os.listdir("sub2")
+                          if name.endswith(cmd_walker.TEMP_SUFFIX)])
+        with open("sub2/test_mixed.js", "rb") as f:
+            self.assertNotEqual(f.read(), content)
+
+    def test_journal_resume(self):
+        journal = os.path.join(self.temp_path, "journal.txt")
+        # Simulate an interrupted run: test_cr.txt was finished, test_lf.txt
+        # was not replaced yet, and gone.txt was killed while being replaced
+        with open(journal, "w") as f:
+            f.write("%s\n" % os.path.abspath("test_cr.txt"))
+        with open("test_lf.txt" + cmd_walker.TEMP_SUFFIX, "wb") as f:
+            f.write(b"incomplete")
+        with open("gone.txt" + cmd_walker.TEMP_SUFFIX, "wb") as f:
+            f.write(b"fixed\n")
+
+        args = ["."]
+        opts = main.Opts()
+        opts.journal_path = journal
+        opts.journal_batch = 3
+        opts.match_list = ["*.txt"]
+        opts.verbose = 1
+
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_rolled_back"), 1)
+        self.assertEqual(data.get("files_recovered"), 1)
+        self.assertEqual(data.get("files_resumed"), 2)
+        self.assertEqual(data.get("files_processed"), 9)
+        self.assertFalse([name for name in os.listdir(".")
+                          if name.endswith(cmd_walker.TEMP_SUFFIX)])
+        with open("gone.txt", "rb") as f:
+            self.assertEqual(f.read(), b"fixed\n")
+
+        # All files are finished now
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_resumed"), 11)
+        self.assertEqual(data.get("files_processed"), 0)
+
+    def test_journal_zip_backup(self):
+        opts = main.Opts()
+        opts.journal_path = os.path.join(self.temp_path, "journal.txt")
+        opts.journal_batch = 1
+        opts.zip_backup = True
+        opts.match_list = ["*.txt"]
+        opts.verbose = 1
+
+        data = {}
+        cmd_walker.process(["."], opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_modified"), 5)
+        # One complete archive part per journal checkpoint, all recorded
+        parts = sorted(os.path.abspath(name) for name in os.listdir(".")
+                       if name.endswith(".zip"))
+        self.assertEqual(sorted(data["zipfile_parts"]), parts)
+        self.assertEqual(len(parts), 5)
+        for part in parts:
+            with ZipFile(part) as zf:
+                self.assertEqual(len(zf.namelist()), 1)
+                self.assertEqual(zf.testzip(), None)
+        with open(opts.journal_path) as f:
+            recorded = [line[len(cmd_walker.JOURNAL_ZIPFILE_PREFIX):].rstrip("\n")
+                        for line in f if line.startswith(cmd_walker.JOURNAL_ZIPFILE_PREFIX)]
+        self.assertEqual(sorted(recorded), parts)
+
+        # Simulate a killed run: the last part has no central directory. The
+        # resumed run warns and adds a new part
+        with open(parts[-1], "r+b") as f:
+            f.truncate(40)
+        with open("test_new.txt", "wb") as f:
+            f.write(b"\tdirty\n")
+        stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        prev_stdout = sys.stdout
+        sys.stdout = stdout
+        try:
+            data = {}
+            cmd_walker.process(["."], opts, main.fix_tabs, data)
+        finally:
+            sys.stdout = prev_stdout
+        self.assertTrue("backup archive is not readable" in stdout.getvalue())
+        self.assertTrue(parts[-1] in stdout.getvalue())
+        self.assertEqual(len(data["zipfile_parts"]), 6)
+        with ZipFile(data["zipfile_parts"][-1]) as zf:
+            self.assertEqual(zf.namelist(), ["test_new.txt"])
+
+    def test_journal_cli(self):
+        journal = os.path.join(self.temp_path, "journal.txt")
+        # Dry-run mode does not record files as finished
+        main.run(["-q", "-n", "-m", "*.txt", "--journal", journal, "."])
+        self.assertFalse(os.path.exists(journal))
+        main.run(["-q", "-m", "*.txt", "--journal", journal, "--journal-batch", "3", "."])
+        with open(journal) as f:
+            self.assertEqual(len(f.read().splitlines()), 10)
+        self.assertTrue(filecmp.cmp("test_mixed.txt",
+                                    os.path.join(os.path.dirname(__file__), "test_mixed_expect_spaced.txt")))
+
+    @unittest.skipUnless(sys.version_info >= (3, 2), "requires Python 3.2+")
+    def test_journal_undecodable_name(self):
+        journal = os.path.join(self.temp_path, "journal.txt")
+        name = os.fsdecode(b"test_\xff.txt")
+        try:
+            with open(name, "wb") as f:
+                f.write(b"\tx\n")
+        except (OSError, UnicodeError):
+            self.skipTest("file system does not accept undecodable names")
+        main.run(["-q", "-m", "*.txt", "--journal", journal, "."])
+        with open(journal, "rb") as f:
+            self.assertTrue(b"/test_\xff.txt\n" in f.read().replace(b"\\", b"/"))
+        # Resumed: the file is not processed again
+        data = {}
+        opts = main.Opts()
+        opts.journal_path = journal
+        opts.match_list = ["*.txt"]
+        opts.verbose = 1
+        cmd_walker.process(["."], opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_resumed"), 11)
+        self.assertEqual(data.get("files_processed"), 0)
+
+    def test_output_dir(self):
+        output_path = os.path.join(self.temp_path, "out")
+        args = ["."]
+        opts = main.Opts()
+        opts.ignore_list = ["sub2"]
+        opts.match_list = ["*.txt", "*.js"]
+        opts.output_path = output_path
+        opts.recursive = True
+        opts.verbose = 1
+
+        # Dry-run: nothing is written (not even temp files in the source tree)
+        temp_fspecs = set()
+
+        def _fix_tabs(fspec, temp_fspec, opts, data):
+            temp_fspecs.add(temp_fspec)
+            return main.fix_tabs(fspec, temp_fspec, opts, data)
+
+        opts.dry_run = True
+        dry_data = {}
+        cmd_walker.process(args, opts, _fix_tabs, dry_data)
+        self.assertEqual(temp_fspecs, set([None]))
+        self.assertFalse(os.path.exists(output_path))
+        opts.dry_run = False
+
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_processed"), 13)
+        self.assertEqual(data.get("files_modified"), 8)
+        self.assertEqual(data.get("files_copied"), 10)
+        for key in ("files_modified", "lines_modified", "bytes_read", "bytes_written"):
+            self.assertEqual(dry_data[key], data[key], key)
+        self.assertFalse(os.path.exists(os.path.join(output_path, "sub2")))
+        self.assertFalse(os.path.exists(os.path.join(output_path, "test_mixed.js.bak")))
+        # Sources are untouched, unmodified and non-matching files are copied
+        self.assertTrue(filecmp.cmp("test_lf.txt", os.path.join(output_path, "test_lf.txt")))
+        self.assertTrue(filecmp.cmp(os.path.join("sub1", "test_odt.odt"),
+                                    os.path.join(output_path, "sub1", "test_odt.odt")))
+        self.assertFalse(filecmp.cmp("test_mixed.js", os.path.join(output_path, "test_mixed.js")))
+
+        # Modified files are the same as with in-place processing
+        output_path2 = os.path.join(self.temp_path, "out2")
+        opts.output_path = output_path2
+        opts.output_link = True
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_linked"), 10)
+        self.assertTrue(os.path.samefile("test_lf.txt", os.path.join(output_path2, "test_lf.txt")))
+
+        opts.output_path = None
+        opts.backup = False
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        for name in ("test_mixed.js", os.path.join("sub1", "test_mixed.txt")):
+            self.assertTrue(filecmp.cmp(name, os.path.join(output_path, name), shallow=False))
+
+    def test_output_dir_copy_fallback(self):
+        def _not_supported(*args):
+            raise OSError(errno.ENOTSOCK, "Socket operation on non-socket")
+
+        output_path = os.path.join(self.temp_path, "out")
+        opts = main.Opts()
+        opts.backup = False
+        opts.match_list = ["*.txt"]
+        opts.output_path = output_path
+        opts.verbose = 1
+
+        names = ("copy_file_range", "sendfile")
+        prev_funcs = cmd_walker._ZERO_COPY_FUNCS
+        prev_os_funcs = [getattr(os, name, None) for name in names]
+        cmd_walker._ZERO_COPY_FUNCS = list(names)
+        for name in names:
+            setattr(os, name, _not_supported)
+        try:
+            data = {}
+            cmd_walker.process(["."], opts, main.fix_tabs, data)
+        finally:
+            cmd_walker._ZERO_COPY_FUNCS = prev_funcs
+            for name, func in zip(names, prev_os_funcs):
+                if func is None:
+                    delattr(os, name)
+                else:
+                    setattr(os, name, func)
+        # Copied by shutil.copyfileobj() instead
+        self.assertEqual(data.get("files_copied"), 9)
+        self.assertTrue(filecmp.cmp("test_lf.txt", os.path.join(output_path, "test_lf.txt"),
+                                    shallow=False))
+
+    def test_progress(self):
+        args = ["."]
+        opts = main.Opts()
+        opts.ignore_list = ["sub2"]
+        opts.match_list = ["*.*"]
+        opts.recursive = True
+        opts.verbose = 1
+
+        data = {}
+        stream = io.StringIO()
+        reporter = ProgressReporter(args, opts, data, stream=stream, interval=0.01)
+        self.assertEqual(reporter.count_files(), 18)
+        reporter.start()
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        reporter.stop()
+        self.assertEqual(data.get("files_processed"), 18)
+        status = stream.getvalue().splitlines()[-1]
+        self.assertTrue(status.startswith("18/18 files (100%), "), status)
+        self.assertTrue("files/s" in status and "MB/s" in status and "ETA" in status)
+
+    def test_profile(self):
+        profile_path = os.path.join(self.temp_path, "profile")
+        args = ["."]
+        opts = main.Opts()
+        opts.match_list = ["*.txt"]
+        opts.verbose = 1
+
+        data = {}
+        stats_fspec, summary_fspec = profiling.profile_process(
+            args, opts, main.fix_tabs, data, profile_path,
+            trace_memory=profiling.can_trace_memory())
+        self.assertEqual(data.get("files_processed"), 10)
+        self.assertTrue(pstats.Stats(stats_fspec).total_calls > 0)
+        with open(summary_fspec) as f:
+            summary = f.read()
+        self.assertTrue("Top 30 files by time:" in summary)
+        self.assertTrue(os.path.abspath("test_mixed.txt") in summary)
+        self.assertTrue("fix_tabs" in summary)
+
+    @unittest.skipUnless(sys.version_info >= (3, 2), "requires Python 3.2+")
+    def test_profile_undecodable_name(self):
+        try:
+            with open(os.fsdecode(b"test_\xff.txt"), "wb") as f:
+                f.write(b"\tx\n")
+        except (OSError, UnicodeError):
+            self.skipTest("file system does not accept undecodable names")
+        opts = main.Opts()
+        opts.match_list = ["*.txt"]
+        opts.verbose = 1
+        data = {}
+        _stats_fspec, summary_fspec = profiling.profile_process(
+            ["."], opts, main.fix_tabs, data, os.path.join(self.temp_path, "profile"))
+        with open(summary_fspec, "rb") as f:
+            self.assertTrue(b"test_\\udcff.txt" in f.read())
+
+    def test_result_cache(self):
+        cache_path = os.path.join(self.temp_path, "cache.bin")
+        args = ["."]
+        opts = main.Opts()
+        opts.backup = False
+        opts.match_list = ["*.*"]
+        opts.recursive = True
+        opts.verbose = 1
+
+        def _run(dry_run, use_cache=True):
+            opts.dry_run = dry_run
+            data = {}
+            if use_cache:
+                data["result_cache"] = result_cache.ResultCache(cache_path, opts)
+            cmd_walker.process(args, opts, main.fix_tabs, data)
+            if use_cache:
+                data.pop("result_cache").save()
+            for key in ("elapsed", "elapsed_string", "visited_dirs", "visited_files"):
+                data.pop(key)
+            return dict((key, value) for key, value in data.items()
+                        if not key.startswith("kernel_"))
+
+        expect = _run(True, use_cache=False)
+        data = _run(True)
+        # sub1 and sub2 contain the same files
+        self.assertEqual((data.pop("cache_hits", 0), data.pop("cache_misses", 0)), (8, 8))
+        self.assertEqual(data, expect)
+        data = _run(True)
+        self.assertEqual((data.pop("cache_hits", 0), data.pop("cache_misses", 0)), (16, 0))
+        self.assertEqual(data, expect)
+
+        # Modified files must be transformed, but the fixed output is cached
+        data = _run(False)
+        self.assertEqual(data.get("files_modified"), 13)
+        self.assertEqual((data.get("cache_hits", 0), data.get("cache_hits_dirty", 0),
+                          data.get("cache_misses", 0)), (3, 13, 0))
+        expect = _run(False, use_cache=False)
+        # Simulate an interrupted save
+        with open(cache_path, "ab") as f:
+            f.write(b"incomplete")
+        data = _run(False)
+        self.assertEqual((data.pop("cache_hits", 0), data.pop("cache_misses", 0)), (16, 0))
+        self.assertEqual(data, expect)
+
+        # Other options use other keys
+        opts.tabbify = True
+        data = _run(True)
+        self.assertEqual((data.pop("cache_hits", 0), data.pop("cache_misses", 0)), (8, 8))
+
+        # Large files (--split-threshold) are looked up, too
+        opts.tabbify = False
+        opts.splitThreshold = 1
+        opts.splitWorkers = 1
+        with open("test_new.txt", "wb") as f:
+            f.write(b"\tdirty\n")
+        data = _run(True)
+        self.assertEqual((data.pop("cache_hits", 0), data.pop("cache_misses", 0)), (16, 1))
+        data = _run(False)
+        self.assertEqual((data.get("cache_hits", 0), data.get("cache_hits_dirty", 0),
+                          data.get("cache_misses", 0)), (16, 1, 0))
+        # (The fixed output of split files is not recorded)
+        data = _run(True)
+        self.assertEqual((data.pop("cache_hits", 0), data.pop("cache_misses", 0)), (16, 1))
+
+    def test_file_types(self):
+        with open("test_mixed_utf8.txt", "rb") as f:
+            text = f.read().decode("utf-8")
+        for encoding, bom in (("utf-16-le", codecs.BOM_UTF16_LE),
+                              ("utf-16-be", codecs.BOM_UTF16_BE),
+                              ("utf-32-le", codecs.BOM_UTF32_LE)):
+            with open("test_bom.txt", "wb") as f:
+                f.write(bom + text.encode(encoding))
+            for tabbify in (False, True):
+                opts = main.Opts()
+                opts.tabbify = tabbify
+                opts.lineSeparator = "LF"
+                opts.verbose = 1
+                expect = fix_file_copy("test_mixed_utf8.txt", opts)[0]
+                res, data = fix_file_copy("test_bom.txt", opts)
+                self.assertEqual(data.get("classified_text_bom"), 1)
+                self.assertTrue(res.startswith(bom))
+                self.assertEqual(res[len(bom):].decode(encoding), expect.decode("utf-8"))
+        os.remove("test_bom.txt")
+
+        # PNG signature, but no NUL byte
+        with open("test_image.dat", "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+        args = ["."]
+        opts = main.Opts()
+        opts.binary_extensions = ["*.rtf"]
+        opts.dry_run = True
+        opts.match_list = ["*.*"]
+        opts.recursive = True
+        opts.verbose = 1
+
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+        self.assertEqual(data.get("files_skipped"), 7)
+        self.assertEqual(data.get("classified_binary_extension"), 4)
+        self.assertEqual(data.get("classified_binary_magic"), 1)
+        # UTF-16 without BOM
+        self.assertEqual(data.get("classified_binary_nul"), 2)
+        self.assertEqual(data.get("classified_text_bom"), 1)
+        self.assertEqual(data.get("classified_text_extension"), 15)
+
+        # Rejected by the walker: the processor is not called and the temp
+        # file is not looked at
+        temp_fspec = os.path.join("sub1", "test_odt.odt" + cmd_walker.TEMP_SUFFIX)
+        with open(temp_fspec, "wb") as f:
+            f.write(b"partial")
+        opts.match_list = ["*.odt"]
+        data = {}
+        cmd_walker.process(args, opts, cmd_walker.piggify, data)
+        self.assertTrue(os.path.exists(temp_fspec))
+        self.assertEqual(data.get("files_processed"), 3)
+        self.assertEqual(data.get("files_skipped"), 3)
+        self.assertEqual(data.get("files_modified"), 0)
+
+    def test_scan(self):
+        args = ["."]
+        opts = main.Opts()
+        opts.dry_run = True
+        opts.read_only = True
+        opts.match_list = ["*.txt"]
+        opts.verbose = 1
+
+        # A temp file of an interrupted run is left alone
+        with open("test_mixed.txt.$temp", "wb") as f:
+            f.write(b"partial")
+        names = sorted(os.listdir("."))
+        data = {"scan_stream": io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()}
+        cmd_walker.process(args, opts, main.scan_file, data)
+        main.write_scan_summary(data)
+        # Read-only: same results as test_spacify_txt_flat, but no files were touched
+        self.assertEqual(sorted(os.listdir(".")), names)
+        with open("test_mixed.txt.$temp", "rb") as f:
+            self.assertEqual(f.read(), b"partial")
+        self.assertEqual(data.get("files_modified"), 0)
+        self.assertEqual(data.get("files_modified_if"), 5)
+        self.assertEqual(data.get("lines_modified"), 125)
+
+        records = [json.loads(line) for line in data["scan_stream"].getvalue().splitlines()]
+        self.assertEqual([r["type"] for r in records], ["file"] * 10 + ["folder"])
+        record = [r for r in records if r["path"].endswith("test_crlf.txt")][0]
+        self.assertEqual(record["line_endings"], {"CR": 0, "LF": 0, "CRLF": 6})
+        self.assertEqual(record["lines"], 7)
+        self.assertEqual(record["space_indented"], 3)
+        self.assertEqual(record["tab_indented"], 0)
+        folder = records[-1]
+        self.assertEqual(folder["files"], 8)
+        self.assertEqual(folder["files_modified"], 5)
+        self.assertEqual(folder["lines_modified"], 125)
+
+        # Recursive: a folder record is written as soon as the walker has left
+        # the folder, every folder once, after all of its files
+        opts.recursive = True
+        data = {"scan_stream": io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()}
+        cmd_walker.process(args, opts, main.scan_file, data)
+        self.assertEqual(len(data["scan_folders"]), 1)
+        main.write_scan_summary(data)
+        self.assertEqual(data["scan_folders"], {})
+        records = [json.loads(line) for line in data["scan_stream"].getvalue().splitlines()]
+        folders = [r["path"] for r in records if r["type"] == "folder"]
+        self.assertEqual(sorted(folders), sorted(set(folders)))
+        self.assertEqual(len(folders), 3)
+        types = [r["type"] for r in records]
+        self.assertTrue(types.index("folder") < len(types) - 1 - types[::-1].index("file"))
+        for i, record in enumerate(records):
+            if record["type"] == "folder":
+                self.assertFalse([r for r in records[i:] if r["type"] == "file"
+                                  and os.path.dirname(r["path"]) == record["path"]])
+
+    def test_split_large_files(self):
+        with open("test_quirks.txt", "wb") as f:
+            f.write(b"a\r\r\n\tb \r\n\rc\rd\r\re\n\r\n  f\rg  \r\r\n\n\n\r\n\r")
+        names = ["test_cr.txt", "test_crlf.txt", "test_lf.txt", "test_mixed.txt",
+                 "test_quirks.txt"]
+        prev_chunk_size = main.SPLIT_MIN_CHUNK_SIZE
+        main.SPLIT_MIN_CHUNK_SIZE = 1
+        try:
+            for name in names:
+                for tabbify in (False, True):
+                    opts = main.Opts()
+                    opts.tabbify = tabbify
+                    opts.verbose = 1
+                    opts.planner = False
+                    expect = fix_file_copy(name, opts)
+                    expect_data = expect[1].copy()
+                    self.assertEqual(expect_data.pop("kernel_general"), 1)
+
+                    opts.splitThreshold = 1
+                    for workers in (1, 2):
+                        opts.splitWorkers = workers
+                        res, data = fix_file_copy(name, opts)
+                        self.assertEqual(data.pop("kernel_split"), 1)
+                        self.assertEqual(res, expect[0], name)
+                        self.assertEqual(data, expect_data, name)
+        finally:
+            main.SPLIT_MIN_CHUNK_SIZE = prev_chunk_size
+
+    def test_split_pool_per_run(self):
+        pools = []
+        used = []
+        prev_create = main.create_split_pool
+        prev_fix_split = main._fix_split
+
+        def create_split_pool(opts):
+            pools.append(prev_create(opts))
+            return pools[-1]
+
+        def fix_split(fspec, opts, pool=None):
+            used.append(pool)
+            return prev_fix_split(fspec, opts, pool)
+
+        prev_chunk_size = main.SPLIT_MIN_CHUNK_SIZE
+        main.SPLIT_MIN_CHUNK_SIZE = 1
+        main.create_split_pool = create_split_pool
+        main._fix_split = fix_split
+        try:
+            # Split files of 100 bytes and more
+            main.run(["-q", "-m", "*.txt", "--split-threshold", "0.0001", "--split-workers", "2",
+                      "."])
+        finally:
+            main.SPLIT_MIN_CHUNK_SIZE = prev_chunk_size
+            main.create_split_pool = prev_create
+            main._fix_split = prev_fix_split
+        # One pool for all files of the run
+        self.assertEqual(len(pools), 1)
+        self.assertTrue(len(used) > 1)
+        self.assertEqual(set(used), set(pools))
+        self.assertTrue(filecmp.cmp("test_mixed.txt",
+                                    os.path.join(os.path.dirname(__file__), "test_mixed_expect_spaced.txt")))
+
+    def test_planner(self):
+        with open("test_quirks.txt", "wb") as f:
+            f.write(b"a\r\r\n\tb \r\n\rc\rd\r\re\n\r\n  f\rg  \r\r\n\n\n\r\n\r")
+        with open("test_clean.txt", "wb") as f:
+            f.write(b"a\n\tb\n")
+        with open("test_trailing.txt", "wb") as f:
+            f.write(b"a  \r\nb\t\r\n\r\n")
+        kernels = set()
+        for name in sorted(os.listdir(".")):
+            if not name.endswith(".txt"):
+                continue
+            for tabbify in (False, True):
+                for separator in (None, "LF", "CRLF"):
+                    opts = main.Opts()
+                    opts.tabbify = tabbify
+                    opts.lineSeparator = separator
+                    opts.verbose = 1
+                    opts.planner = False
+                    expect, expect_data = fix_file_copy(name, opts)
+                    expect_data.pop("kernel_general", None)
+
+                    opts.planner = True
+                    res, data = fix_file_copy(name, opts)
+                    for key in list(data):
+                        if key.startswith("kernel_"):
+                            kernels.add(key)
+                            data.pop(key)
+                    self.assertEqual(res, expect, name)
+                    self.assertEqual(data, expect_data, name)
+        self.assertEqual(kernels, set(["kernel_clean", "kernel_general",
+                                       "kernel_separator", "kernel_trailing"]))
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "requires os.symlink")
+    def test_recursive_links(self):
+        # Hardlink a file, and create a symlink loop: sub1/loop -> ..
+        os.link("test_lf.txt", os.path.join("sub1", "test_lf_hardlink.txt"))
+        os.symlink(os.pardir, os.path.join("sub1", "loop"))
+
+        args = ["."]
+        opts = main.Opts()
+        opts.match_list = ["*.*"]
+        opts.recursive = True
+
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+
+        self.assertEqual(data.get("files_processed"), 22)
+        self.assertEqual(data.get("files_deduplicated"), 1)
+        self.assertEqual(data.get("dirs_processed"), 3)
+        self.assertEqual(data.get("dirs_deduplicated"), 1)
+
+        opts.follow_symlinks = False
+        data = {}
+        cmd_walker.process(args, opts, main.fix_tabs, data)
+
+        self.assertEqual(data.get("links_skipped"), 1)
+        self.assertEqual(data.get("dirs_deduplicated"), 0)
+
+    @unittest.skipUnless(hasattr(os, "link"), "requires os.link")
+    def test_hardlinks(self):
+        # The names inside the walked tree are linked to the new file, the
+        # name outside keeps the old file
+        os.mkdir("links")
+        a_fspec, b_fspec = os.path.join("links", "a.txt"), os.path.join("links", "b.txt")
+        c_fspec = os.path.join(self.temp_path, "c.txt")
+        for durability, content, expect in (("none", b"\tx  \n", b"    x\n"),
+                                            ("batch", b"\t\tx\n", b"        x\n")):
+            for fspec in (a_fspec, b_fspec, c_fspec):
+                if os.path.exists(fspec):
+                    os.remove(fspec)
+            with open(a_fspec, "wb") as f:
+                f.write(content)
+            os.link(a_fspec, b_fspec)
+            os.link(a_fspec, c_fspec)
+            opts = main.Opts()
+            opts.backup = True
+            opts.durability = durability
+            opts.match_list = ["*.txt"]
+            opts.verbose = 1
+
+            data = {}
+            cmd_walker.process(["links"], opts, main.fix_tabs, data)
+            self.assertEqual(data.get("files_modified"), 1)
+            self.assertEqual(data.get("files_deduplicated"), 1)
+            self.assertEqual(data.get("files_relinked"), 1)
+            self.assertTrue(os.path.samefile(a_fspec, b_fspec))
+            self.assertFalse(os.path.samefile(a_fspec, c_fspec))
+            for fspec in (a_fspec, b_fspec):
+                with open(fspec, "rb") as f:
+                    self.assertEqual(f.read(), expect)
+            with open(c_fspec, "rb") as f:
+                self.assertEqual(f.read(), content)
+            backups = [name for name in os.listdir("links") if name.endswith(".bak")]
+            self.assertEqual(len(backups), 1)
+            with open(os.path.join("links", backups[0]), "rb") as f:
+                self.assertEqual(f.read(), content)
+            os.remove(os.path.join("links", backups[0]))
+            self.assertFalse([name for name in os.listdir("links")
+                              if name.endswith(cmd_walker.TEMP_SUFFIX)])
+
+    def test_walk_threads(self):
+        if hasattr(os, "symlink"):
+            os.symlink(os.pardir, os.path.join("sub1", "loop"))
+        listed = []
+
+        def _list_folder(path):
+            listed.append(path)
+            return cmd_walker.list_folder(path)
+
+        results = []
+        for threads, ordered in ((0, True), (4, True), (4, False)):
+            args = ["."]
+            opts = main.Opts()
+            opts.dry_run = True
+            opts.ignore_list = ["*.js"]
+            opts.match_list = ["*.txt", "*.html"]
+            opts.recursive = True
+            opts.verbose = 1
+            opts.walk_threads = threads
+            opts.walk_ordered = ordered
+
+            visited = []
+
+            def _func(fspec, target_fspec, opts, data):
+                visited.append(fspec)
+                return main.fix_tabs(fspec, target_fspec, opts, data)
+
+            data = {}
+            del listed[:]
+            cmd_walker.process(args, opts, _func, data, list_func=_list_folder)
+            self.assertTrue(len(listed) >= 3)
+            for key in ("elapsed", "elapsed_string", "visited_dirs", "visited_files"):
+                data.pop(key)
+            results.append((visited, data))
+
+        self.assertEqual(results[0][1].get("files_processed"), 15)
+        self.assertEqual(results[0][1].get("files_ignored"), 7)
+        # Same order with threads
+        self.assertEqual(results[1], results[0])
+        # Unordered: same files and statistics
+        self.assertEqual(sorted(results[2][0]), sorted(results[0][0]))
+        self.assertEqual(results[2][1], results[0][1])
+
+    def test_iter_files(self):
+        opts = main.Opts()
+        opts.ignore_list = ["*.js"]
+        opts.match_list = ["*.txt", "*.html"]
+        opts.recursive = True
+        opts.verbose = 0
+
+        with open("test_lf.txt" + cmd_walker.TEMP_SUFFIX, "wb") as f:
+            f.write(b"partial")
+        visited = []
+        expected = {}
+        opts.read_only = True
+        cmd_walker.process(["."], opts, lambda f, t, o, d: visited.append(f) or False, expected)
+        # Same files, but nothing is processed and temp files are not touched
+        opts.read_only = False
+        data = {}
+        files = list(cmd_walker.iter_files(["."], opts, data))
+        self.assertEqual([os.path.abspath(f) for f in files], visited)
+        self.assertTrue(os.path.exists("test_lf.txt" + cmd_walker.TEMP_SUFFIX))
+        for key in ("files_ignored", "dirs_processed", "files_deduplicated"):
+            self.assertEqual(data[key], expected[key], key)
+        self.assertEqual(data["files_processed"], 0)
+
+    def test_pipeline(self):
+        results = []
+        for read_ahead, read_ahead_bytes, write_behind in ((0, 0, 0), (4, 1 << 20, 2),
+                                                           (3, 0, 0), (0, 0, 1)):
+            path = os.path.join(self.temp_path, "pipeline_%d" % len(results))
+            shutil.copytree(".", path)
+            opts = main.Opts()
+            opts.ignore_list = ["*.js"]
+            opts.match_list = ["*.txt", "*.html"]
+            opts.recursive = True
+            opts.verbose = 0
+            opts.durability = "file"
+            opts.journal_path = os.path.join(self.temp_path, "journal_%d.txt" % len(results))
+            opts.read_ahead = read_ahead
+            opts.read_ahead_bytes = read_ahead_bytes
+            opts.write_behind = write_behind
+
+            data = {}
+            cmd_walker.process([path], opts, main.fix_tabs, data)
+            self.assertFalse("pipeline" in data)
+            with open(opts.journal_path) as f:
+                journal = sorted(os.path.relpath(line.strip(), path) for line in f)
+            contents = []
+            for folder, _dirs, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    with open(os.path.join(folder, name), "rb") as f:
+                        contents.append((os.path.relpath(f.name, path), f.read()))
+            read_ahead_stats = [data.pop(key) for key in
+                                ("files_read_ahead", "bytes_read_ahead", "files_advised")]
+            for key in ("elapsed", "elapsed_string", "visited_dirs", "visited_files",
+                        "journal", "journal_done"):
+                data.pop(key)
+            results.append((contents, journal, data, read_ahead_stats))
+
+        self.assertEqual(results[0][2].get("files_processed"), 15)
+        self.assertEqual(results[0][3], [0, 0, 0])
+        # Binary files (by extension) are not read ahead
+        self.assertTrue(0 < results[1][3][0] < 15)
+        self.assertTrue(results[1][3][1] >= results[0][2]["bytes_read"])
+        # Budget exceeded: nothing buffered
+        self.assertEqual(results[2][3][:2], [0, 0])
+        for res in results[1:]:
+            self.assertEqual(res[:3], results[0][:3])
+
+    @unittest.skipUnless(sys.version_info >= (3, 7), "requires Python 3.7+")
+    def test_asyncio(self):
+        import asyncio
+        import contextlib
+        import tabfix
+
+        def _make_opts():
+            opts = main.Opts()
+            opts.dry_run = True
+            opts.ignore_list = ["*.js"]
+            opts.match_list = ["*.txt", "*.html"]
+            opts.recursive = True
+            opts.verbose = 0
+            return opts
+
+        expected = {}
+        cmd_walker.process(["."], _make_opts(), main.fix_tabs, expected)
+
+        data = asyncio.run(tabfix.fix_paths(["."], _make_opts(), max_workers=3))
+        for key in ("files_processed", "files_modified", "files_skipped",
+                    "files_ignored", "dirs_processed", "lines_processed",
+                    "lines_modified", "bytes_read", "bytes_written"):
+            self.assertEqual(data[key], expected[key], key)
+
+        async def _iter_some(opts, count):
+            results = []
+            gen = tabfix.iter_fix(["."], opts, max_workers=2, max_pending=1)
+            try:
+                async for result in gen:
+                    results.append(result)
+                    if len(results) == count:
+                        break
+            finally:
+                await gen.aclose()
+            return results
+
+        # Stop early: the walker is cancelled and no temp files are left
+        results = asyncio.run(_iter_some(_make_opts(), 3))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(r.error is None for r in results))
+        for folder, _dirs, files in os.walk("."):
+            self.assertFalse([f for f in files if f.endswith(cmd_walker.TEMP_SUFFIX)])
+
+        opts = _make_opts()
+        opts.durability = "batch"
+        self.assertRaises(ValueError, asyncio.run, _iter_some(opts, 1))
+        self.assertRaises(ValueError, asyncio.run, tabfix.fix_paths(["."], opts))
+
+        # Default options: a library call prints nothing
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            data = asyncio.run(tabfix.fix_paths(["test_mixed.txt"]))
+        self.assertEqual(data["files_modified"], 1)
+        self.assertEqual(stdout.getvalue(), "")
+
+
+@unittest.skipUnless(main.np, "requires NumPy")
+class TestEngines(TestFilesCase):
+    """Compare the NumPy engine against the reference implementation."""
+
+    def _assert_same_result(self, fspec, **kwargs):
+        results = []
+        for engine in main.ENGINES:
+            opts = main.Opts()
+            opts.engine = engine
+            # Files that the planner takes would never reach the NumPy engine
+            opts.planner = False
+            opts.verbose = 1
+            for name, value in kwargs.items():
+                setattr(opts, name, value)
+            res, data = fix_file_copy(fspec, opts)
+            kernel = "kernel_%s" % ("numpy" if engine == "numpy" else "general")
+            self.assertEqual(data.pop(kernel, 0), 0 if data.get("files_skipped") else 1)
+            results.append((res, data))
+        self.assertEqual(results[0], results[1], "%s %s" % (fspec, kwargs))
+
+    def test_test_files(self):
+        for name in sorted(os.listdir(".")):
+            if not name.endswith(".txt"):
+                continue
+            for tabbify in (False, True):
+                for separator in (None, "LF", "CRLF", "CR"):
+                    self._assert_same_result(name, tabbify=tabbify, lineSeparator=separator)
+                self._assert_same_result(name, tabbify=tabbify, tabSize=2, inputTabSize=8)
+
+    def test_random_files(self):
+        rnd = random.Random(42)
+        chars = [b"\r", b"\n", b"\r\n", b" ", b" ", b"\t", b"\t", b"\xa0", b"x"]
+        for _ in range(500):
+            with open("test_random.txt", "wb") as f:
+                f.write(b"".join(rnd.choice(chars) for _ in range(rnd.randint(1, 60))))
+            self._assert_same_result("test_random.txt",
+                                     tabbify=rnd.choice((False, True)),
+                                     tabSize=rnd.choice((2, 4, 8)),
+                                     inputTabSize=rnd.choice((None, 3, 8)))
+
+    def test_blocks(self):
+        # Every line in its own block
+        prev_block_size = main.NUMPY_BLOCK_SIZE
+        main.NUMPY_BLOCK_SIZE = 1
+        try:
+            self.test_test_files()
+            self.test_random_files()
+        finally:
+            main.NUMPY_BLOCK_SIZE = prev_block_size
+
 
 #class TestShell(unittest.TestCase):
 #    """Basic tests.